@@ -1,28 +1,373 @@
 #!/usr/bin/env python3
 import argparse
+import fcntl
+import os
+import re
+import sqlite3
+import threading
+from array import array
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import ChainMap
+from collections.abc import Mapping
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from errno import ENXIO
+from fcntl import F_RDLCK
+from fcntl import F_UNLCK
+from fcntl import LOCK_EX
+from fcntl import LOCK_SH
+from fcntl import flock
+from fcntl import ioctl
+from functools import lru_cache
+from functools import partial
+from hashlib import blake2b
+from hashlib import sha256
+from mmap import ACCESS_READ
+from mmap import MADV_SEQUENTIAL
+from mmap import mmap
+from multiprocessing import get_context
+from os import SEEK_DATA
+from os import SEEK_HOLE
+from os import fstat
+from os import lseek
+from os import makedirs
+from os import major
+from os import minor
 from os import path
+from os import preadv
+from os import replace
+from os import stat
+from os import stat_result
 from os import walk
 from pathlib import Path
-from re import search
+from signal import SIGURG
+from struct import Struct
+from typing import Iterator
+from typing import NamedTuple
+from xxhash import xxh3_128
+from xxhash import xxh3_64
 from xxhash import xxh64
+from xxhash import xxh64_intdigest
 
+HASH_ALGORITHMS = {
+    "xxh64": xxh64,
+    "xxh3_64": xxh3_64,
+    "xxh3_128": xxh3_128,
+    "blake2b": blake2b,
+    "sha256": sha256,
+}
+DEFAULT_ALGORITHM = "xxh64"
+STAGES = ("size", "partial", "full")
+CACHE_LINE_PATTERN = re.compile(
+    "(?:([a-z0-9_-]+):)?([a-f0-9]{16,128})[ \t]+'?([^'\n]+)'?")
+HEX_DIGEST_PATTERN = re.compile("[a-f0-9]{16,128}")
+CACHE_MANIFEST = "manifest"
+SHARD_BUFFER_LINES = 65536
+PACKED_CACHE_MAGIC = b"XCOMPPK1"
+PACKED_CACHE_HEADER = Struct("=8s32sQQ")
+PACKED_CACHE_RECORD = Struct("=QQLLqq")
+COMPARE_BUFFER_SIZE = 1024 * 1024
+READ_BUFFER_SIZE = 1024 * 1024
+IO_MODES = ("read", "mmap", "auto")
+MMAP_THRESHOLD = 64 * 1024 * 1024
+MMAP_SLICE_SIZE = 16 * 1024 * 1024
+TREE_BLOCK_SIZE = 64 * 1024 * 1024
+ZERO_BUFFER = memoryview(bytes(1024 * 1024))
+EXECUTORS = ("thread", "process")
+PROCESS_BATCH_SIZE = 512
+SYSFS_DEVICE_PATH = "/sys/dev/block"
+ORDERS = ("walk", "inode", "extent")
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = Struct("=QQLLLL")
+FIEMAP_EXTENT = Struct("=QQQQQLLLL")
+FIEMAP_EXTENT_COUNT = 64
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST = 0x1
+FIEMAP_EXTENT_SHARED = 0x2000
+# UNKNOWN, DELALLOC, ENCODED, DATA_ENCRYPTED, NOT_ALIGNED, DATA_INLINE and
+# DATA_TAIL extents have no stable physical location to compare
+FIEMAP_EXTENT_UNSHARED_FLAGS = (0x2 | 0x4 | 0x8 | 0x80 | 0x100 | 0x200 |
+                                0x400)
+FIEMAP_MAX_OFFSET = 2 ** 64 - 1
+LABEL_KIND = 255
 
-def xxh3(file_name: str) -> str:
-    if path.exists(file_name):
-        hash_object = xxh64()
-        with open(file_name, "rb") as f:
-            for chunk in iter(lambda: f.read(1024), b""):
-                hash_object.update(chunk)
-        return hash_object.hexdigest()
+thread_state = threading.local()
+
+
+class CacheEntry(NamedTuple):
+    digest: str
+    blocks: tuple[str, ...] = ()
+    size: int | None = None
+    mtime_ns: int | None = None
+    inode: int | None = None
+    device: int | None = None
+
+
+class FileStat(NamedTuple):
+    st_dev: int
+    st_ino: int
+    st_size: int
+    st_mtime_ns: int
+    st_nlink: int
+
+
+def format_digest(algorithm: str, hexdigest: str) -> str:
+    if algorithm == DEFAULT_ALGORITHM:
+        return hexdigest
+    return f"{algorithm}:{hexdigest}"
+
+
+def get_hash_object(algorithm: str):
+    hash_objects = vars(thread_state).setdefault("hash_objects", {})
+    hash_object = hash_objects.get(algorithm)
+    if hash_object is None or not hasattr(hash_object, "reset"):
+        hash_object = HASH_ALGORITHMS[algorithm]()
+        hash_objects[algorithm] = hash_object
     else:
+        hash_object.reset()
+    return hash_object
+
+
+def get_read_buffer(file_size: int) -> memoryview:
+    if not hasattr(thread_state, "read_buffer"):
+        thread_state.read_buffer = memoryview(bytearray(READ_BUFFER_SIZE))
+    return thread_state.read_buffer[:min(file_size + 1, READ_BUFFER_SIZE)]
+
+
+def hash_read_file(f, hash_object, file_size: int) -> None:
+    buffer = get_read_buffer(file_size)
+    while read_size := f.readinto(buffer):
+        hash_object.update(buffer[:read_size])
+
+
+def is_sparse(file_stat: stat_result) -> bool:
+    return file_stat.st_blocks * 512 < file_stat.st_size
+
+
+def get_data_ranges(fd: int, start: int, end: int) -> list[tuple[int, int]]:
+    data_ranges: list[tuple[int, int]] = []
+    offset = start
+    while offset < end:
+        try:
+            data_start = lseek(fd, offset, SEEK_DATA)
+        except OSError as error:
+            if error.errno == ENXIO:
+                break
+            return [(start, end)]
+        if data_start >= end:
+            break
+        data_end = min(lseek(fd, data_start, SEEK_HOLE), end)
+        data_ranges.append((data_start, data_end))
+        offset = data_end
+    return data_ranges
+
+
+def hash_zeros(hash_object, length: int) -> None:
+    while length > 0:
+        hash_object.update(ZERO_BUFFER[:length])
+        length -= len(ZERO_BUFFER)
+
+
+def hash_range(
+    fd: int, hash_object, start: int, end: int, sparse: bool = False
+) -> None:
+    buffer = get_read_buffer(READ_BUFFER_SIZE)
+    data_ranges = get_data_ranges(fd, start, end) if sparse else [
+        (start, end)]
+    offset = start
+    for data_start, data_end in data_ranges + [(end, end)]:
+        hash_zeros(hash_object, data_start - offset)
+        offset = data_start
+        while offset < data_end:
+            read_size = preadv(fd, [buffer[:data_end - offset]], offset)
+            if not read_size:
+                return
+            hash_object.update(buffer[:read_size])
+            offset += read_size
+
+
+def hash_mapped_file(f, hash_object, file_size: int) -> bool:
+    # A read lease makes truncations and opens for writing wait until it is
+    # released, so no mapped page can vanish under the hash (SIGBUS). The
+    # lease break is signalled with SIGURG, which is ignored by default.
+    # Leases are Linux only; elsewhere the file is read instead.
+    set_signal = getattr(fcntl, "F_SETSIG", None)
+    set_lease = getattr(fcntl, "F_SETLEASE", None)
+    get_lease = getattr(fcntl, "F_GETLEASE", None)
+    if set_signal is None or set_lease is None or get_lease is None:
+        return False
+
+    try:
+        fcntl.fcntl(f.fileno(), set_signal, SIGURG)
+        fcntl.fcntl(f.fileno(), set_lease, F_RDLCK)
+    except OSError:
+        return False
+
+    try:
+        mapping = mmap(f.fileno(), file_size, access=ACCESS_READ)
+    except (OSError, ValueError):
+        fcntl.fcntl(f.fileno(), set_lease, F_UNLCK)
+        return False
+
+    try:
+        with mapping:
+            if hasattr(mapping, "madvise"):
+                mapping.madvise(MADV_SEQUENTIAL)
+            with memoryview(mapping) as view:
+                for offset in range(0, file_size, MMAP_SLICE_SIZE):
+                    if fcntl.fcntl(f.fileno(), get_lease) != F_RDLCK:
+                        return False
+                    hash_object.update(view[offset:offset + MMAP_SLICE_SIZE])
+    finally:
+        fcntl.fcntl(f.fileno(), set_lease, F_UNLCK)
+
+    return True
+
+
+def xxh3(
+    file_name: str,
+    algorithm: str = DEFAULT_ALGORITHM,
+    io_mode: str = "read",
+    mmap_threshold: int = MMAP_THRESHOLD
+) -> str:
+    try:
+        f = open(file_name, "rb", buffering=0)
+    except FileNotFoundError:
         print(f"the target path doesn't exist: {file_name}")
         raise SystemExit(1)
 
+    hash_object = get_hash_object(algorithm)
+    with f:
+        file_stat = fstat(f.fileno())
+        file_size = file_stat.st_size
+        use_mmap = (io_mode == "mmap" or
+                    (io_mode == "auto" and file_size >= mmap_threshold))
+        if is_sparse(file_stat):
+            hash_range(f.fileno(), hash_object, 0, file_size, True)
+        elif not use_mmap or not hash_mapped_file(f, hash_object, file_size):
+            if use_mmap:
+                hash_object = get_hash_object(algorithm)
+            hash_read_file(f, hash_object, file_size)
+    return format_digest(algorithm, hash_object.hexdigest())
+
+
+def hash_block(
+    fd: int, offset: int, length: int, algorithm: str, sparse: bool = False
+) -> bytes:
+    hash_object = get_hash_object(algorithm)
+    hash_range(fd, hash_object, offset, offset + length, sparse)
+    return hash_object.digest()
+
+
+def get_checkpoint_digests(
+    checkpoint: CacheEntry | None,
+    file_stat: stat_result,
+    block_size: int,
+    hash_offset
+) -> list[bytes]:
+    if (not checkpoint or not checkpoint.blocks or checkpoint.size is None or
+            file_stat.st_size <= checkpoint.size):
+        return []
+
+    complete_blocks = min(checkpoint.size // block_size,
+                          len(checkpoint.blocks))
+    if not complete_blocks:
+        return []
+    last_digest = hash_offset((complete_blocks - 1) * block_size)
+    if last_digest.hex() != checkpoint.blocks[complete_blocks - 1]:
+        return []
+    return [bytes.fromhex(digest)
+            for digest in checkpoint.blocks[:complete_blocks - 1]] + [
+        last_digest]
+
 
-def read_arguments():
+def tree_hash(
+    file_name: str,
+    algorithm: str = DEFAULT_ALGORITHM,
+    block_size: int = TREE_BLOCK_SIZE,
+    jobs: int = 1,
+    block_maps: dict[str, tuple[str, ...]] | None = None,
+    checkpoints: Mapping[str, CacheEntry] | None = None
+) -> str:
+    try:
+        fd = os.open(file_name, os.O_RDONLY)
+    except FileNotFoundError:
+        print(f"the target path doesn't exist: {file_name}")
+        raise SystemExit(1)
+
+    try:
+        file_stat = fstat(fd)
+        hash_offset = partial(hash_block, fd, length=block_size,
+                              algorithm=algorithm,
+                              sparse=is_sparse(file_stat))
+        digests = get_checkpoint_digests(
+            (checkpoints or {}).get(file_name), file_stat, block_size,
+            hash_offset)
+        offsets = range(len(digests) * block_size,
+                        max(file_stat.st_size, 1), block_size)
+        if jobs > 1 and len(offsets) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(jobs, len(offsets))
+            ) as executor:
+                digests += executor.map(hash_offset, offsets)
+        else:
+            digests += [hash_offset(offset) for offset in offsets]
+    finally:
+        os.close(fd)
+
+    if block_maps is not None:
+        block_maps[file_name] = tuple(digest.hex() for digest in digests)
+    root = HASH_ALGORITHMS[algorithm](b"".join(digests)).hexdigest()
+    return format_digest(f"{algorithm}-tree-{block_size}", root)
+
+
+def sample_hash(file_name: str, sample_size: int) -> str:
+    with open(file_name, "rb") as f:
+        file_size = fstat(f.fileno()).st_size
+        hash_object = xxh64(seed=file_size)
+        for offset in (0,
+                       (file_size - sample_size) // 2,
+                       file_size - sample_size):
+            f.seek(offset)
+            hash_object.update(f.read(sample_size))
+    return hash_object.hexdigest()
+
+
+def parse_stages(value: str) -> list[str]:
+    stages = value.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            raise argparse.ArgumentTypeError(
+                f"invalid stage: '{stage}' (choose from {', '.join(STAGES)})")
+    if "full" not in stages:
+        raise argparse.ArgumentTypeError("the full stage can't be disabled")
+    return stages
+
+
+def parse_positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError(
+            f"invalid positive integer: '{value}'")
+    return number
+
+
+def default_jobs() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def read_arguments(argv: list[str] | None = None):
     arg_parser = argparse.ArgumentParser(
         prog="xcomp",
-        description=("Compare two paths using xxh3 hash algorithm. "
+        description=("Compare two paths using the xxhash family of hash "
+                     "algorithms (or another available one). "
                      "Paths must be both files or both directories."),
         epilog="written by Rodrigo Viana Rocha"
     )
@@ -43,7 +388,37 @@ def read_arguments():
         action="append",
         help=("use one or more plain text files as cache for the "
               "file hash computation. All lines in the cache file(s) should "
-              "like: d50463dd92503d34 '/path/to/file'")
+              "like: d50463dd92503d34 '/path/to/file', optionally followed "
+              "by size=<bytes> mtime_ns=<ns> to have stale entries rehashed. "
+              "A directory written by 'xcomp_cache.py shard' is read as a "
+              "sharded cache, loading only the shards overlapping the "
+              "compared paths, and a file written by 'xcomp_cache.py pack' "
+              "is memory-mapped and searched in place")
+    )
+
+    arg_parser.add_argument(
+        "--update-cache",
+        metavar="FILE",
+        help=("plain text cache file read like --cache_file when it exists, "
+              "and to which every file hashed while comparing directories is "
+              "appended under an exclusive lock")
+    )
+
+    arg_parser.add_argument(
+        "--cache-root",
+        metavar="DIR",
+        help=("directory relative paths in the cache files are resolved "
+              "against, instead of the current directory. Files under it are "
+              "written to --update-cache relative to it, so a cache built on "
+              "one mount point can be reused from another")
+    )
+
+    arg_parser.add_argument(
+        "--cache-db",
+        help=("SQLite database used as a persistent hash cache. Entries are "
+              "trusted only while the size, mtime, inode and device of the "
+              "file still match, and every file hashed while comparing "
+              "directories is written back to it")
     )
 
     arg_parser.add_argument(
@@ -62,77 +437,1331 @@ def read_arguments():
         help="show the hexdigest and respective full path of each file"
     )
 
-    args = arg_parser.parse_args()
+    arg_parser.add_argument(
+        "-a",
+        "--algorithm",
+        default=DEFAULT_ALGORITHM,
+        choices=HASH_ALGORITHMS,
+        help=("hash algorithm used to compute file digests. Digests other "
+              "than xxh64 are tagged with the algorithm name, e.g. "
+              "xxh3_64:d50463dd92503d34, and cache entries produced by "
+              "other algorithms are ignored (default: xxh64)")
+    )
+
+    arg_parser.add_argument(
+        "-j",
+        "--jobs",
+        default=default_jobs(),
+        type=int,
+        help=("number of files hashed at the same time on each "
+              "non-rotational device when comparing directories "
+              "(default: the number of CPUs available to xcomp)")
+    )
+
+    arg_parser.add_argument(
+        "--hdd-jobs",
+        default=1,
+        type=int,
+        help=("number of files hashed at the same time on each rotational "
+              "device, --jobs applies to every other device (default: 1)")
+    )
+
+    arg_parser.add_argument(
+        "--reflinks",
+        action="store_true",
+        help=("treat same-size files whose physical extents are identical "
+              "(reflinked copy-on-write clones on btrfs or XFS, reported by "
+              "FIEMAP) as equal without reading them. Files without usable "
+              "extent information are hashed as usual")
+    )
+
+    arg_parser.add_argument(
+        "--order",
+        default="walk",
+        choices=ORDERS,
+        help=("order in which the files of each device are hashed: 'walk' "
+              "keeps the directory walk order, 'inode' sorts them by inode "
+              "number and 'extent' by the physical offset of their first "
+              "extent, falling back to inode order where FIEMAP isn't "
+              "supported. Sorting reduces seeks on rotational disks "
+              "(default: walk)")
+    )
+
+    arg_parser.add_argument(
+        "--executor",
+        default="thread",
+        choices=EXECUTORS,
+        help=("run the --jobs hashing workers as threads or as processes. "
+              "Processes avoid the GIL on trees made of many small files "
+              "and receive the files in batches (default: thread)")
+    )
+
+    arg_parser.add_argument(
+        "--io-mode",
+        default="read",
+        choices=IO_MODES,
+        help=("how file contents are fed to the hash algorithm: 'read' "
+              "copies them through a reusable buffer, 'mmap' hashes a "
+              "memory map of each file and 'auto' maps only the files "
+              "bigger than --mmap-threshold. A file is only mapped while "
+              "holding a Linux read lease on it, which needs the file to "
+              "be owned by the user (or CAP_LEASE) and not open for "
+              "writing elsewhere; other files are read (default: read)")
+    )
+
+    arg_parser.add_argument(
+        "--mmap-threshold",
+        default=MMAP_THRESHOLD,
+        type=int,
+        help=("minimum size in bytes of the files memory mapped by "
+              f"--io-mode auto (default: {MMAP_THRESHOLD})")
+    )
+
+    arg_parser.add_argument(
+        "--tree-hash",
+        action="store_true",
+        help=("hash each file as a tree of --block-size blocks, read and "
+              "hashed in parallel, whose digests are combined into a root "
+              "digest tagged as <algorithm>-tree-<block size>. --verbose "
+              "also prints the block digests, which cache files keep")
+    )
+
+    arg_parser.add_argument(
+        "--block-size",
+        default=TREE_BLOCK_SIZE,
+        type=parse_positive_int,
+        help=("size in bytes of the blocks used by --tree-hash "
+              f"(default: {TREE_BLOCK_SIZE})")
+    )
+
+    arg_parser.add_argument(
+        "--blocks",
+        action="store_true",
+        help=("when comparing two files, hash both of them as --tree-hash "
+              "does and print every differing byte range as "
+              "!<first byte>-<last byte>. A block map found in the cache "
+              "file(s) for one of the files spares reading it")
+    )
+
+    arg_parser.add_argument(
+        "--stages",
+        default=list(STAGES),
+        type=parse_stages,
+        help=("comma separated stages used to tell directory contents apart "
+              "before hashing whole files: 'size' skips files with a unique "
+              "size, 'partial' hashes only the first, middle and last "
+              "samples of same-size files (default: size,partial,full)")
+    )
+
+    arg_parser.add_argument(
+        "--sample-size",
+        default=4096,
+        type=parse_positive_int,
+        help=("size in bytes of each sample read by the partial stage "
+              "(default: 4096)")
+    )
+
+    args = arg_parser.parse_args(argv)
     return args
 
 
-def load_hash_cache(args) -> dict[str, str]:
-    hash_cache: dict[str, str] = {}
+def is_cache_entry_current(
+    cache_entry: CacheEntry, file_stat: FileStat | stat_result
+) -> bool:
+    if cache_entry.size is None:
+        return True
+    if cache_entry.inode is not None and (
+            cache_entry.inode != file_stat.st_ino or
+            cache_entry.device != file_stat.st_dev):
+        return False
+    return (cache_entry.size == file_stat.st_size and
+            cache_entry.mtime_ns == file_stat.st_mtime_ns)
+
+
+def format_hash_line(
+    hash: str,
+    file_full_path: str,
+    blocks: tuple[str, ...] = (),
+    cached: bool = False,
+    file_stat: FileStat | stat_result | None = None
+) -> str:
+    line = f"{hash} '{file_full_path}'"
+    if file_stat:
+        line += (f" size={file_stat.st_size}"
+                 f" mtime_ns={file_stat.st_mtime_ns}")
+    if blocks:
+        line += f" blocks={','.join(blocks)}"
+    if cached:
+        line += " cached"
+    return line
+
+
+def get_cache_path(file_full_path: str, cache_root: str | None) -> str:
+    if not cache_root:
+        return file_full_path
+    cache_root = path.join(path.abspath(cache_root), "")
+    if file_full_path.startswith(cache_root):
+        return file_full_path[len(cache_root):]
+    return file_full_path
+
+
+def open_cache_database(file_name: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(file_name)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS hashes ("
+        "path TEXT NOT NULL, "
+        "tag TEXT NOT NULL, "
+        "digest TEXT NOT NULL, "
+        "size INTEGER NOT NULL, "
+        "mtime_ns INTEGER NOT NULL, "
+        "inode INTEGER NOT NULL, "
+        "device INTEGER NOT NULL, "
+        "blocks TEXT NOT NULL, "
+        "PRIMARY KEY (path, tag)) WITHOUT ROWID"
+    )
+    return connection
+
+
+def load_cache_database(
+    connection: sqlite3.Connection, directory_path: str, digest_tag: str
+) -> dict[str, CacheEntry]:
+    prefix = path.join(path.abspath(directory_path), "")
+    rows = connection.execute(
+        "SELECT path, digest, blocks, size, mtime_ns, inode, device "
+        "FROM hashes WHERE tag = ? AND path >= ? AND path < ?",
+        (digest_tag, prefix, prefix[:-1] + "0"))
+    return {
+        file_full_path: CacheEntry(
+            digest, tuple(blocks.split(",")) if blocks else (), size,
+            mtime_ns, inode, device)
+        for file_full_path, digest, blocks, size, mtime_ns, inode, device
+        in rows
+    }
+
+
+def get_cache_database_entry(
+    connection: sqlite3.Connection, file_full_path: str, digest_tag: str
+) -> CacheEntry | None:
+    row = connection.execute(
+        "SELECT digest, blocks, size, mtime_ns, inode, device "
+        "FROM hashes WHERE path = ? AND tag = ?",
+        (file_full_path, digest_tag)).fetchone()
+    if not row:
+        return None
+    digest, blocks, size, mtime_ns, inode, device = row
+    return CacheEntry(digest, tuple(blocks.split(",")) if blocks else (),
+                      size, mtime_ns, inode, device)
+
+
+def update_cache_database(
+    connection: sqlite3.Connection,
+    digest_tag: str,
+    entries: list[tuple[str, CacheEntry]]
+) -> None:
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(file_full_path, digest_tag, cache_entry.digest, cache_entry.size,
+              cache_entry.mtime_ns, cache_entry.inode, cache_entry.device,
+              ",".join(cache_entry.blocks))
+             for file_full_path, cache_entry in entries])
+
+
+def append_hash_cache(file_name: str, lines: list[str]) -> None:
+    if not lines:
+        return
+    with open(file_name, "a+b") as file_object:
+        flock(file_object, LOCK_EX)
+        end = file_object.seek(0, os.SEEK_END)
+        if end:
+            file_object.seek(end - 1)
+            if file_object.read(1) != b"\n":
+                # Drop the torn last line, however long, back to the newline
+                # ending the line before it
+                while end:
+                    start = file_object.seek(max(end - READ_BUFFER_SIZE, 0))
+                    newline = file_object.read(end - start).rfind(b"\n")
+                    if newline >= 0:
+                        end = start + newline + 1
+                        break
+                    end = start
+                file_object.truncate(end)
+        file_object.write("".join(f"{line}\n" for line in lines).encode())
+        file_object.flush()
+
+
+def get_digest_tag(args) -> str:
+    if args.tree_hash or args.blocks:
+        return f"{args.algorithm}-tree-{args.block_size}"
+    return args.algorithm
+
+
+def split_cache_line(line: str) -> tuple[str, str, str, str] | None:
+    digest, _, rest = line.partition(" ")
+    algorithm, _, hex_digest = digest.rpartition(":")
+    end = rest.find("'", 1)
+    if (rest[:1] == "'" and end > 1 and
+            HEX_DIGEST_PATTERN.fullmatch(hex_digest)):
+        return algorithm, hex_digest, rest[1:end], rest[end + 1:]
+
+    match = CACHE_LINE_PATTERN.search(line)
+    if not match:
+        return None
+    return (match.group(1) or "", match.group(2), match.group(3),
+            line[match.end():])
+
+
+def parse_cache_fields(
+    fields: str
+) -> tuple[tuple[str, ...], int | None, int | None]:
+    blocks: tuple[str, ...] = ()
+    size = mtime_ns = None
+    for field in fields.split():
+        name, _, value = field.partition("=")
+        if name == "blocks":
+            blocks = tuple(value.split(","))
+        elif name == "size" and value.isdigit():
+            size = int(value)
+        elif name == "mtime_ns" and value.isdigit():
+            mtime_ns = int(value)
+    return blocks, size, mtime_ns
+
+
+def get_shard_prefix(file_path: str, depth: int) -> str:
+    if file_path.startswith("/"):
+        depth += 1
+    directory_parts = file_path.split("/")[:-1][:depth]
+    return "/".join(directory_parts) + "/" if directory_parts else ""
+
+
+def shard_hash_cache(
+    cache_files: list[str], directory: str, depth: int
+) -> int:
+    shard_names: dict[str, str] = {}
+    pending: dict[str, list[str]] = {}
+    pending_lines = 0
+
+    def flush_shards() -> None:
+        for prefix, lines in pending.items():
+            shard_path = path.join(directory, f"{shard_names[prefix]}.tmp")
+            with open(shard_path, "at") as shard_file:
+                shard_file.writelines(lines)
+        pending.clear()
+
+    manifest_path = path.join(directory, CACHE_MANIFEST)
+    makedirs(directory, exist_ok=True)
+    try:
+        for cache_file in cache_files:
+            with open(cache_file, "rt") as file_object:
+                for line in file_object:
+                    parts = split_cache_line(line)
+                    if not parts:
+                        continue
+                    prefix = get_shard_prefix(parts[2], depth)
+                    if prefix not in shard_names:
+                        shard_names[prefix] = f"{len(shard_names):05}.txt"
+                        open(path.join(directory,
+                                       f"{shard_names[prefix]}.tmp"),
+                             "wt").close()
+                    pending.setdefault(prefix, []).append(
+                        line if line.endswith("\n") else f"{line}\n")
+                    pending_lines += 1
+                    if pending_lines >= SHARD_BUFFER_LINES:
+                        flush_shards()
+                        pending_lines = 0
+        flush_shards()
+
+        with open(f"{manifest_path}.tmp", "wt") as manifest:
+            for prefix, shard_name in shard_names.items():
+                manifest.write(f"{shard_name}\t{prefix}\n")
+    except BaseException:
+        for shard_name in shard_names.values():
+            Path(directory, f"{shard_name}.tmp").unlink(missing_ok=True)
+        Path(f"{manifest_path}.tmp").unlink(missing_ok=True)
+        raise
+
+    for shard_name in shard_names.values():
+        replace(path.join(directory, f"{shard_name}.tmp"),
+                path.join(directory, shard_name))
+    replace(f"{manifest_path}.tmp", manifest_path)
+    return len(shard_names)
+
+
+def select_cache_shards(
+    directory: str, cache_root: str, prefixes: tuple[str, ...]
+) -> list[str]:
+    manifest_path = path.join(directory, CACHE_MANIFEST)
+    if not path.exists(manifest_path):
+        print(f"xcomp: the cache directory ({directory}) has no manifest")
+        raise SystemExit(1)
+
+    shards: list[str] = []
+    with open(manifest_path, "rt") as manifest:
+        for line in manifest:
+            shard_name, _, prefix = line.rstrip("\n").partition("\t")
+            prefix = path.join(path.abspath(path.join(cache_root, prefix)),
+                               "")
+            if not prefixes or any(
+                    prefix.startswith(root) or root.startswith(prefix)
+                    for root in prefixes):
+                shards.append(path.join(directory, shard_name))
+    return shards
+
+
+class PackedCache(Mapping):
+    def __init__(self, file_name: str, cache_root: str) -> None:
+        with open(file_name, "rb") as file_object:
+            self.buffer = mmap(file_object.fileno(), 0, access=ACCESS_READ)
+        _, digest_tag, self.count, self.heap_offset = (
+            PACKED_CACHE_HEADER.unpack_from(self.buffer))
+        self.digest_tag = digest_tag.rstrip(b"\0").decode()
+        self.cache_root = cache_root
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[str]:
+        for file_path, _ in self.records():
+            yield path.abspath(path.join(self.cache_root, file_path))
+
+    def __getitem__(self, file_full_path: str) -> CacheEntry:
+        index = self.find(os.fsencode(file_full_path))
+        if index is None and file_full_path.startswith(self.cache_root):
+            index = self.find(
+                os.fsencode(file_full_path[len(self.cache_root):]))
+        if index is None:
+            raise KeyError(file_full_path)
+        return self.decode_record(index)[1]
+
+    def get_record(self, index: int) -> tuple[int, int, int, int, int, int]:
+        return PACKED_CACHE_RECORD.unpack_from(
+            self.buffer,
+            PACKED_CACHE_HEADER.size + index * PACKED_CACHE_RECORD.size)
+
+    def get_path_hash(self, index: int) -> int:
+        return self.get_record(index)[0]
+
+    def find(self, encoded_path: bytes) -> int | None:
+        path_hash = xxh64_intdigest(encoded_path)
+        index = bisect_left(range(self.count), path_hash,
+                            key=self.get_path_hash)
+        while index < self.count:
+            record_hash, offset, path_length, _, _, _ = self.get_record(index)
+            if record_hash != path_hash:
+                break
+            start = self.heap_offset + offset
+            if self.buffer[start:start + path_length] == encoded_path:
+                return index
+            index += 1
+        return None
+
+    def decode_record(self, index: int) -> tuple[str, CacheEntry]:
+        _, offset, path_length, entry_length, size, mtime_ns = (
+            self.get_record(index))
+        start = self.heap_offset + offset
+        file_path = os.fsdecode(self.buffer[start:start + path_length])
+        start += path_length
+        hex_digest, _, blocks = (
+            self.buffer[start:start + entry_length].decode().partition(" "))
+        return file_path, CacheEntry(
+            format_digest(self.digest_tag, hex_digest),
+            tuple(blocks.split(",")) if blocks else (),
+            size if size >= 0 else None,
+            mtime_ns if mtime_ns >= 0 else None)
+
+    def records(self) -> Iterator[tuple[str, CacheEntry]]:
+        for index in range(self.count):
+            yield self.decode_record(index)
+
+
+def is_packed_cache(file_name: str) -> bool:
+    with open(file_name, "rb") as file_object:
+        return file_object.read(len(PACKED_CACHE_MAGIC)) == PACKED_CACHE_MAGIC
+
+
+def pack_hash_cache(
+    cache_files: list[str], file_name: str, digest_tag: str
+) -> int:
+    entries: dict[bytes, tuple[bytes, int, int]] = {}
+    for cache_file in cache_files:
+        with open(cache_file, "rt") as file_object:
+            for line in file_object:
+                parts = split_cache_line(line)
+                if not parts:
+                    continue
+                algorithm, hex_digest, file_path, fields = parts
+                if (algorithm or DEFAULT_ALGORITHM) != digest_tag:
+                    continue
+                if not algorithm and len(hex_digest) != 16:
+                    continue
+                blocks, size, mtime_ns = parse_cache_fields(fields)
+                if blocks:
+                    hex_digest += f" {','.join(blocks)}"
+                entries[os.fsencode(path.normpath(file_path))] = (
+                    hex_digest.encode(),
+                    -1 if size is None else size,
+                    -1 if mtime_ns is None else mtime_ns)
+
+    records = sorted((xxh64_intdigest(encoded_path), encoded_path, *entry)
+                     for encoded_path, entry in entries.items())
+    heap_offset = (PACKED_CACHE_HEADER.size +
+                   len(records) * PACKED_CACHE_RECORD.size)
+    with open(f"{file_name}.tmp", "wb") as packed_cache:
+        packed_cache.write(PACKED_CACHE_HEADER.pack(
+            PACKED_CACHE_MAGIC, digest_tag.encode(), len(records),
+            heap_offset))
+        offset = 0
+        for path_hash, encoded_path, entry, size, mtime_ns in records:
+            packed_cache.write(PACKED_CACHE_RECORD.pack(
+                path_hash, offset, len(encoded_path), len(entry), size,
+                mtime_ns))
+            offset += len(encoded_path) + len(entry)
+        for _, encoded_path, entry, _, _ in records:
+            packed_cache.write(encoded_path + entry)
+    replace(f"{file_name}.tmp", file_name)
+    return len(records)
+
+
+def unpack_hash_cache(file_name: str, output_file: str) -> int:
+    packed_cache = PackedCache(file_name, "")
+    with open(output_file, "wt") as file_object:
+        for file_path, cache_entry in packed_cache.records():
+            line = f"{cache_entry.digest} '{file_path}'"
+            if cache_entry.size is not None:
+                line += f" size={cache_entry.size}"
+            if cache_entry.mtime_ns is not None:
+                line += f" mtime_ns={cache_entry.mtime_ns}"
+            if cache_entry.blocks:
+                line += f" blocks={','.join(cache_entry.blocks)}"
+            file_object.write(f"{line}\n")
+    return len(packed_cache)
+
+
+def load_hash_cache(
+    args, roots: list[str] | None = None
+) -> MutableMapping[str, CacheEntry]:
+    hash_cache: dict[str, CacheEntry] = {}
+    packed_caches: list[PackedCache] = []
+    digest_tag = get_digest_tag(args)
     at_least_one_match = False
+    cache_files = list(args.cache_file or [])
+    if args.update_cache and path.exists(args.update_cache):
+        cache_files.append(args.update_cache)
+    cache_root = path.join(path.abspath(args.cache_root or ""), "")
+    prefixes = tuple(path.join(path.abspath(root), "") if path.isdir(root)
+                     else path.abspath(root) for root in roots or ())
+    relative_prefixes = tuple(
+        prefix[len(cache_root):] if prefix.startswith(cache_root) else ""
+        for prefix in prefixes
+        if prefix.startswith(cache_root) or cache_root.startswith(prefix))
+    cache_files = [
+        shard for file in cache_files
+        for shard in (select_cache_shards(file, cache_root, prefixes)
+                      if path.isdir(file) else [file])]
 
-    for file in args.cache_file:
+    for file in cache_files:
         full_file_path = Path(file)
         if not full_file_path.exists():
             print(f"xcomp: the cache file ({file}) doesn't exist")
             raise SystemExit(1)
-        file_object = open(full_file_path, "rt")
-        for line in file_object:
-            match = search("([a-f0-9]{16})[ \t]+'?([^'\n]+)'?", line)
-            if match:
+        if is_packed_cache(file):
+            at_least_one_match = True
+            packed_cache = PackedCache(file, cache_root)
+            if packed_cache.digest_tag == digest_tag:
+                packed_caches.append(packed_cache)
+            continue
+        with open(full_file_path, "rt") as file_object:
+            flock(file_object, LOCK_SH)
+            written_by_xcomp = file == args.update_cache
+            for line in file_object:
+                if written_by_xcomp and not line.endswith("\n"):
+                    continue
+                start = line.find(" '") + 2
+                if (prefixes and 1 < start < len(line) and
+                        line[start] != "." and
+                        not line.startswith(prefixes if line[start] == "/"
+                                            else relative_prefixes, start) and
+                        "/." not in line and "//" not in line):
+                    if HEX_DIGEST_PATTERN.fullmatch(
+                            line[:start - 2].rpartition(":")[2]):
+                        at_least_one_match = True
+                    continue
+                parts = split_cache_line(line)
+                if not parts:
+                    continue
                 at_least_one_match = True
-                hash_cache[path.abspath(match.group(2))] = match.group(1)
+                algorithm, hex_digest, file_path, fields = parts
+                if (algorithm or DEFAULT_ALGORITHM) != digest_tag:
+                    continue
+                if not algorithm and len(hex_digest) != 16:
+                    continue
+                if (file_path[:1] != "/" or file_path[-1:] == "/" or
+                        "/." in file_path or "//" in file_path):
+                    file_path = path.abspath(path.join(cache_root, file_path))
+                if prefixes and not file_path.startswith(prefixes):
+                    continue
+
+                hash_cache[file_path] = CacheEntry(
+                    format_digest(digest_tag, hex_digest),
+                    *parse_cache_fields(fields))
 
-    if not at_least_one_match:
+    if not at_least_one_match and any(file != args.update_cache
+                                      for file in cache_files):
         print(
             (f"xcomp: the cache file ({file}) doesn't comply with "
                 "format requirements")
         )
         raise SystemExit(1)
 
+    if packed_caches:
+        return ChainMap(hash_cache, *reversed(packed_caches))
     return hash_cache
 
 
-def get_hash_dict(directory_path: str, args) -> dict[str, list[str]]:
-    result_dict: dict[str, list[str]] = {}
-    hash_cache: dict[str, str] = {}
+class FileTable(Mapping):
+    def __init__(self) -> None:
+        self.rows: dict[str, int] = {}
+        self.columns = tuple(array(code) for code in "QQQqQ")
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.rows)
+
+    def __getitem__(self, file_full_path: str) -> FileStat:
+        return self.get_stat(self.rows[file_full_path])
+
+    def get_stat(self, row: int) -> FileStat:
+        return FileStat(*(column[row] for column in self.columns))
 
-    if args.cache_file:
-        hash_cache = load_hash_cache(args)
+    def add(self, file_full_path: str, file_stat: stat_result) -> None:
+        self.rows[file_full_path] = len(self.rows)
+        for column, value in zip(self.columns, (
+                file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+                file_stat.st_mtime_ns, file_stat.st_nlink)):
+            column.append(value)
+
+    def entries(self) -> Iterator[tuple[str, FileStat]]:
+        for file_full_path, row in self.rows.items():
+            yield file_full_path, self.get_stat(row)
+
+
+def scan_directory(directory_path: str, args) -> FileTable:
+    file_table = FileTable()
 
     for current_directory, _, file_names in walk(directory_path):
         for file_name in file_names:
             file_full_path = path.abspath(
                 path.join(current_directory, file_name))
 
-            if file_full_path in hash_cache:
-                hash = hash_cache[file_full_path]
-                if args.verbose:
-                    print(f"{hash} '{file_full_path}' cached")
+            try:
+                file_stat = stat(file_full_path)
+            except FileNotFoundError:
+                print(f"the target path doesn't exist: {file_full_path}")
+                raise SystemExit(1)
+
+            file_table.add(file_full_path, file_stat)
+
+        if not args.recursive:
+            return file_table
+
+    return file_table
+
+
+def hash_batch(
+    hash_function, first_index: int, file_paths: list[str]
+) -> tuple[int, str, bytes]:
+    algorithm = ""
+    digests = bytearray()
+    for file_name in file_paths:
+        algorithm, _, hexdigest = hash_function(file_name).rpartition(":")
+        digests += bytes.fromhex(hexdigest)
+    return first_index, algorithm, bytes(digests)
+
+
+def hash_files(
+    file_paths: list[str], hash_function, jobs: int, executor: str = "thread"
+) -> list[str]:
+    if jobs <= 1 or len(file_paths) <= 1:
+        return [hash_function(file_name) for file_name in file_paths]
+
+    if executor == "thread":
+        with ThreadPoolExecutor(max_workers=jobs) as thread_executor:
+            return list(thread_executor.map(hash_function, file_paths))
+
+    hashes: list[str] = [""] * len(file_paths)
+    first_indexes = range(0, len(file_paths), PROCESS_BATCH_SIZE)
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=get_context("forkserver")) as process_executor:
+        for first_index, algorithm, digests in process_executor.map(
+            partial(hash_batch, hash_function),
+            first_indexes,
+            [file_paths[index:index + PROCESS_BATCH_SIZE]
+             for index in first_indexes]
+        ):
+            batch_size = min(PROCESS_BATCH_SIZE, len(file_paths) - first_index)
+            width = len(digests) // batch_size
+            for index in range(batch_size):
+                hexdigest = digests[index * width:(index + 1) * width].hex()
+                hashes[first_index + index] = (
+                    f"{algorithm}:{hexdigest}" if algorithm else hexdigest)
+    return hashes
+
+
+@lru_cache(maxsize=None)
+def is_rotational(device: int) -> bool:
+    block_path = path.realpath(
+        path.join(SYSFS_DEVICE_PATH, f"{major(device)}:{minor(device)}"))
+    for queue_path in (path.join(block_path, "queue"),
+                       path.join(path.dirname(block_path), "queue")):
+        try:
+            with open(path.join(queue_path, "rotational"), "rt") as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+
+def get_extents(
+    file_name: str, limit: int | None = None, fiemap_flags: int = 0
+) -> list[tuple[int, int, int, int]]:
+    extents: list[tuple[int, int, int, int]] = []
+    extent_count = min(FIEMAP_EXTENT_COUNT, limit or FIEMAP_EXTENT_COUNT)
+    buffer = bytearray(FIEMAP_HEADER.size + extent_count * FIEMAP_EXTENT.size)
+    start = 0
+
+    with open(file_name, "rb", buffering=0) as f:
+        while limit is None or len(extents) < limit:
+            if limit is not None:
+                extent_count = min(extent_count, limit - len(extents))
+            FIEMAP_HEADER.pack_into(buffer, 0, start, FIEMAP_MAX_OFFSET,
+                                    fiemap_flags, 0, extent_count, 0)
+            ioctl(f.fileno(), FS_IOC_FIEMAP, buffer)
+            mapped_extents = FIEMAP_HEADER.unpack_from(buffer)[3]
+            if not mapped_extents:
+                break
+
+            for index in range(mapped_extents):
+                logical, physical, length, _, _, flags, *_ = (
+                    FIEMAP_EXTENT.unpack_from(
+                        buffer,
+                        FIEMAP_HEADER.size + index * FIEMAP_EXTENT.size))
+                extents.append((logical, physical, length, flags))
+
+            if flags & FIEMAP_EXTENT_LAST:
+                break
+            start = logical + length
+
+    return extents
+
+
+def get_extent_signature(
+    file_name: str, file_stat: FileStat
+) -> tuple | None:
+    # Syncing first flushes writes still held in a copy-on-write fork, whose
+    # data FIEMAP would otherwise report at the old shared extents
+    try:
+        extents = get_extents(file_name, fiemap_flags=FIEMAP_FLAG_SYNC)
+    except OSError:
+        return None
+
+    if not extents or any(flags & FIEMAP_EXTENT_UNSHARED_FLAGS or
+                          not flags & FIEMAP_EXTENT_SHARED
+                          for *_, flags in extents):
+        return None
+    return (file_stat.st_dev, file_stat.st_size,
+            tuple(extent[:3] for extent in extents))
+
+
+def find_clones(
+    file_paths: list[str], file_stats: Mapping[str, FileStat]
+) -> dict[str, str]:
+    clones: dict[str, str] = {}
+    originals: dict[tuple, str] = {}
+    for file_full_path in file_paths:
+        signature = get_extent_signature(
+            file_full_path, file_stats[file_full_path])
+        if signature is None:
+            continue
+        if signature in originals:
+            clones[file_full_path] = originals[signature]
+        else:
+            originals[signature] = file_full_path
+    return clones
+
+
+def sort_device_files(file_names: list[str],
+                      file_stats: Mapping[str, FileStat],
+                      order: str) -> None:
+    if order == "walk":
+        return
+
+    if order == "extent":
+        physical_offsets: dict[str, int] = {}
+        try:
+            for file_name in file_names:
+                extents = get_extents(file_name, 1)
+                physical_offsets[file_name] = extents[0][1] if extents else 0
+        except OSError:
+            pass
+        else:
+            file_names.sort(key=lambda file_name: (
+                physical_offsets[file_name], file_stats[file_name].st_ino))
+            return
+
+    file_names.sort(key=lambda file_name: file_stats[file_name].st_ino)
+
+
+def hash_device_files(
+    file_paths: dict[str, None],
+    file_stats: Mapping[str, FileStat],
+    hash_function,
+    args,
+    executor: str | None = None,
+    block_size: int | None = None
+) -> dict[str, str]:
+    device_files: dict[int, list[str]] = {}
+    for file_full_path in file_paths:
+        device = file_stats[file_full_path].st_dev
+        if device in device_files:
+            device_files[device].append(file_full_path)
+        else:
+            device_files[device] = [file_full_path]
+
+    def hash_device(device: int) -> list[str]:
+        file_names = device_files[device]
+        sort_device_files(file_names, file_stats, args.order)
+        jobs = args.hdd_jobs if is_rotational(device) else args.jobs
+        if block_size is None:
+            return hash_files(file_names, hash_function, jobs,
+                              executor or args.executor)
+
+        # Files spanning several blocks get the whole device budget for
+        # their blocks, one file at a time, instead of a pool per file
+        single_blocks = [file_name for file_name in file_names
+                         if file_stats[file_name].st_size <= block_size]
+        hashes = dict(zip(single_blocks, hash_files(
+            single_blocks, partial(hash_function, jobs=1), jobs,
+            executor or args.executor)))
+        return [hashes[file_name] if file_name in hashes
+                else hash_function(file_name, jobs=jobs)
+                for file_name in file_names]
+
+    hashes: dict[str, str] = {}
+    with ThreadPoolExecutor(
+        max_workers=max(len(device_files), 1)
+    ) as device_executor:
+        for device, device_hashes in zip(
+            device_files, device_executor.map(hash_device, device_files)
+        ):
+            hashes.update(zip(device_files[device], device_hashes))
+    return hashes
+
+
+class HashIndex:
+    def __init__(self) -> None:
+        self.directories: list[str] = []
+        self.directory_ids: dict[str, int] = {}
+        self.directory_column = array("L")
+        self.name_heap = bytearray()
+        self.name_ends = array("Q")
+        self.kinds: list[str] = []
+        self.kind_ids: dict[str, int] = {}
+        self.kind_column = bytearray()
+        self.digest_column = array("Q")
+        self.labels: dict[str, int | list[int]] = {}
+        self.order = array("L")
+
+    def __len__(self) -> int:
+        return len(self.directory_column)
+
+    def __contains__(self, key: str) -> bool:
+        return bool(self.get_file_ids(key))
+
+    def __getitem__(self, key: str) -> list[str]:
+        file_ids = self.get_file_ids(key)
+        if not file_ids:
+            raise KeyError(key)
+        return [self.get_path(file_id) for file_id in file_ids]
+
+    def encode_key(
+        self, key: str, add: bool = False
+    ) -> tuple[int, int] | None:
+        kind, _, value = key.rpartition(":")
+        if kind == "size" and value.isdigit() and int(value) < 2 ** 64:
+            number = int(value)
+        elif len(value) == 16 and HEX_DIGEST_PATTERN.fullmatch(value):
+            number = int(value, 16)
+        else:
+            return None
+
+        if kind not in self.kind_ids:
+            if not add or len(self.kinds) == LABEL_KIND:
+                return None
+            self.kind_ids[kind] = len(self.kinds)
+            self.kinds.append(kind)
+        return self.kind_ids[kind], number
+
+    def decode_key(self, file_id: int) -> str:
+        kind = self.kinds[self.kind_column[file_id]]
+        number = self.digest_column[file_id]
+        if kind == "size":
+            return f"size:{number}"
+        if kind:
+            return f"{kind}:{number:016x}"
+        return f"{number:016x}"
+
+    def get_sort_key(self, file_id: int) -> int:
+        return self.kind_column[file_id] << 64 | self.digest_column[file_id]
+
+    def get_path(self, file_id: int) -> str:
+        start = self.name_ends[file_id - 1] if file_id else 0
+        return path.join(
+            self.directories[self.directory_column[file_id]],
+            os.fsdecode(bytes(self.name_heap[start:self.name_ends[file_id]])))
+
+    def add(self, key: str, file_full_path: str) -> None:
+        file_id = len(self)
+        directory, name = path.split(file_full_path)
+        if directory not in self.directory_ids:
+            self.directory_ids[directory] = len(self.directories)
+            self.directories.append(directory)
+        self.directory_column.append(self.directory_ids[directory])
+        self.name_heap += os.fsencode(name)
+        self.name_ends.append(len(self.name_heap))
+
+        encoded_key = self.encode_key(key, add=True)
+        if encoded_key:
+            self.kind_column.append(encoded_key[0])
+            self.digest_column.append(encoded_key[1])
+            return
+
+        self.kind_column.append(LABEL_KIND)
+        self.digest_column.append(0)
+        file_ids = self.labels.get(key)
+        if file_ids is None:
+            self.labels[key] = file_id
+        elif isinstance(file_ids, int):
+            self.labels[key] = [file_ids, file_id]
+        else:
+            file_ids.append(file_id)
+
+    def freeze(self) -> None:
+        self.order = array("L", sorted(
+            (file_id for file_id in range(len(self))
+             if self.kind_column[file_id] != LABEL_KIND),
+            key=self.get_sort_key))
+
+    def get_file_ids(self, key: str) -> list[int]:
+        encoded_key = self.encode_key(key)
+        if not encoded_key:
+            file_ids = self.labels.get(key, [])
+            return [file_ids] if isinstance(file_ids, int) else file_ids
+
+        sort_key = encoded_key[0] << 64 | encoded_key[1]
+        start = bisect_left(self.order, sort_key, key=self.get_sort_key)
+        end = bisect_right(self.order, sort_key, start,
+                           key=self.get_sort_key)
+        return list(self.order[start:end])
+
+    def items(self) -> Iterator[tuple[str, list[str]]]:
+        # Groups come out in the walk order of their first file, like the
+        # former dict of path lists
+        first_ids = bytearray(len(self))
+        start = 0
+        while start < len(self.order):
+            sort_key = self.get_sort_key(self.order[start])
+            first_ids[self.order[start]] = 1
+            start += 1
+            while (start < len(self.order) and
+                   self.get_sort_key(self.order[start]) == sort_key):
+                start += 1
+        label_keys = {
+            file_ids if isinstance(file_ids, int) else file_ids[0]: key
+            for key, file_ids in self.labels.items()}
+
+        for file_id in range(len(self)):
+            if file_id in label_keys:
+                key = label_keys[file_id]
+            elif first_ids[file_id]:
+                key = self.decode_key(file_id)
             else:
-                hash = xxh3(file_full_path)
-                if args.verbose:
-                    print(f"{hash} '{file_full_path}'")
+                continue
+            yield key, [self.get_path(group_id)
+                        for group_id in self.get_file_ids(key)]
+
+
+def get_hash_dicts(
+    directory_paths: list[str], args
+) -> list[HashIndex]:
+    hash_cache: MutableMapping[str, CacheEntry] = {}
+    database_cache: dict[str, CacheEntry] = {}
+    block_maps: dict[str, tuple[str, ...]] = {}
+    keys: dict[str, str] = {}
+    pending: dict[str, None] = {}
+    sampled: dict[str, None] = {}
+    inode_paths: dict[tuple[int, int], str] = {}
+    link_counts: dict[str, int] = {}
+    candidate_groups: dict[int, str | list[str]] = {}
+    current: set[str] = set()
+    stale = 0
+
+    if args.cache_file or args.update_cache:
+        hash_cache = load_hash_cache(args, directory_paths)
 
-            if hash in result_dict:
-                result_dict[hash].append(file_full_path)
+    if args.cache_db:
+        cache_database = open_cache_database(args.cache_db)
+        for directory_path in directory_paths:
+            database_cache.update(load_cache_database(
+                cache_database, directory_path, get_digest_tag(args)))
+
+    with ThreadPoolExecutor(max_workers=len(directory_paths)) as executor:
+        trees = list(executor.map(partial(scan_directory, args=args),
+                                  directory_paths))
+    file_stats = ChainMap(*trees)
+
+    for index, tree in enumerate(trees):
+        for file_full_path, file_stat in tree.entries():
+            representative = file_full_path
+            if file_stat.st_nlink > 1:
+                representative = inode_paths.setdefault(
+                    (file_stat.st_dev, file_stat.st_ino), file_full_path)
+            if representative != file_full_path:
+                link_counts[representative] = (
+                    link_counts.get(representative, 0) + 1)
+            elif not any(file_full_path in earlier_tree
+                         for earlier_tree in trees[:index]):
+                group = file_stat.st_size if "size" in args.stages else 0
+                file_paths = candidate_groups.get(group)
+                if file_paths is None:
+                    candidate_groups[group] = file_full_path
+                elif isinstance(file_paths, str):
+                    candidate_groups[group] = [file_paths, file_full_path]
+                else:
+                    file_paths.append(file_full_path)
+
+            cache_entry = hash_cache.get(file_full_path)
+            if file_full_path in database_cache and not (
+                    cache_entry and
+                    is_cache_entry_current(cache_entry, file_stat)):
+                cache_entry = database_cache[file_full_path]
+                hash_cache[file_full_path] = cache_entry
+            if not cache_entry:
+                continue
+            if not is_cache_entry_current(cache_entry, file_stat):
+                stale += 1
             else:
-                result_dict[hash] = [file_full_path]
+                current.add(file_full_path)
+                keys.setdefault(representative, cache_entry.digest)
+                block_maps.setdefault(representative, cache_entry.blocks)
 
-        if not args.recursive:
-            return result_dict
+    clones: dict[str, str] = {}
+    if args.reflinks:
+        for file_paths in candidate_groups.values():
+            if isinstance(file_paths, list):
+                clones.update(find_clones(file_paths, file_stats))
+                file_paths[:] = [file_full_path
+                                 for file_full_path in file_paths
+                                 if file_full_path not in clones]
+
+        for clone, original in clones.items():
+            if clone in keys:
+                keys.setdefault(original, keys[clone])
+
+    cached = set(keys)
+    for group, file_paths in candidate_groups.items():
+        if isinstance(file_paths, str):
+            file_paths = [file_paths]
+        uncached = [file_full_path for file_full_path in file_paths
+                    if file_full_path not in keys]
+
+        if args.verbose or len(uncached) < len(file_paths):
+            pending.update(dict.fromkeys(uncached))
+        elif len(file_paths) == 1 and "size" in args.stages:
+            keys[file_paths[0]] = f"size:{group}"
+        elif "partial" in args.stages:
+            for file_full_path in uncached:
+                if file_stats[file_full_path].st_size > 3 * args.sample_size:
+                    sampled[file_full_path] = None
+                else:
+                    pending[file_full_path] = None
+        else:
+            pending.update(dict.fromkeys(uncached))
+
+    sample_groups: dict[str, list[str]] = {}
+    samples = hash_device_files(
+        sampled, file_stats,
+        partial(sample_hash, sample_size=args.sample_size), args)
+    for file_full_path in sampled:
+        sample = samples[file_full_path]
+        if sample in sample_groups:
+            sample_groups[sample].append(file_full_path)
+        else:
+            sample_groups[sample] = [file_full_path]
+
+    for sample, file_paths in sample_groups.items():
+        if len(file_paths) == 1:
+            keys[file_paths[0]] = f"partial:{sample}"
+        else:
+            pending.update(dict.fromkeys(file_paths))
 
-    return result_dict
+    if args.tree_hash:
+        keys.update(hash_device_files(
+            pending, file_stats,
+            partial(tree_hash, algorithm=args.algorithm,
+                    block_size=args.block_size, block_maps=block_maps,
+                    checkpoints=hash_cache),
+            args, "thread", args.block_size))
+    else:
+        keys.update(hash_device_files(
+            pending, file_stats,
+            partial(xxh3, algorithm=args.algorithm, io_mode=args.io_mode,
+                    mmap_threshold=args.mmap_threshold),
+            args))
+
+    for clone, original in clones.items():
+        keys[clone] = keys[original]
+        if original in block_maps:
+            block_maps[clone] = block_maps[original]
+
+    scanned = sum(len(tree) for tree in trees)
+    extra_links = 0
+    saved_bytes = 0
+    for file_full_path, link_count in link_counts.items():
+        if file_full_path not in cached:
+            extra_links += link_count
+            saved_bytes += link_count * file_stats[file_full_path].st_size
+    cloned_bytes = sum(file_stats[clone].st_size for clone in clones)
+
+    # Only the keys and the links between files are needed from here on, so
+    # each table is dropped as soon as its index is built
+    hash_cache = {}
+    database_cache.clear()
+    candidate_groups.clear()
+    sample_groups.clear()
+    samples.clear()
+    file_stats.maps.clear()
+
+    updated_entries: list[tuple[str, CacheEntry]] = []
+    updated_lines: list[str] = []
+    hash_indexes: list[HashIndex] = []
+    while trees:
+        tree = trees.pop(0)
+        hash_index = HashIndex()
+        for file_full_path, file_stat in tree.entries():
+            representative = inode_paths.get(
+                (file_stat.st_dev, file_stat.st_ino), file_full_path)
+            hash = keys[representative]
+            if clones.get(representative, representative) in pending:
+                if args.cache_db:
+                    updated_entries.append((file_full_path, CacheEntry(
+                        hash, block_maps.get(representative, ()),
+                        file_stat.st_size, file_stat.st_mtime_ns,
+                        file_stat.st_ino, file_stat.st_dev)))
+                if args.update_cache:
+                    updated_lines.append(format_hash_line(
+                        hash, get_cache_path(file_full_path, args.cache_root),
+                        block_maps.get(representative, ()),
+                        file_stat=file_stat))
+            if args.verbose:
+                print(format_hash_line(
+                    hash, file_full_path, block_maps.get(representative, ()),
+                    file_full_path in current, file_stat))
+
+            hash_index.add(hash, file_full_path)
+
+        del tree
+        hash_index.freeze()
+        hash_indexes.append(hash_index)
+
+    if args.cache_db:
+        update_cache_database(cache_database, get_digest_tag(args),
+                              updated_entries)
+        cache_database.close()
+
+    if args.update_cache:
+        append_hash_cache(args.update_cache, updated_lines)
+
+    if args.verbose:
+        if extra_links:
+            print(f"xcomp: {extra_links} hardlink(s) to inodes already "
+                  f"hashed, {saved_bytes} bytes not reread")
+        if clones:
+            print(f"xcomp: {len(clones)} reflinked clone(s) matched by their "
+                  f"extents, {cloned_bytes} bytes not reread")
+        if args.cache_file or args.update_cache or args.cache_db:
+            print(f"xcomp: cache: {len(current)} hit(s), "
+                  f"{scanned - len(current) - stale} miss(es), "
+                  f"{stale} stale")
+
+    return hash_indexes
+
+
+def find_first_difference(chunk1: bytes, chunk2: bytes) -> int:
+    view1 = memoryview(chunk1)
+    view2 = memoryview(chunk2)
+    start, end = 0, min(len(chunk1), len(chunk2))
+    while start < end:
+        middle = (start + end) // 2
+        if view1[start:middle + 1] == view2[start:middle + 1]:
+            start = middle + 1
+        else:
+            end = middle
+    return start
+
+
+def compare_files(
+    file_name1: str, file_name2: str, verbose: bool,
+    algorithm: str = DEFAULT_ALGORITHM, io_mode: str = "read",
+    mmap_threshold: int = MMAP_THRESHOLD
+) -> tuple[bool, str, str]:
+    file_stat1 = stat(file_name1)
+    file_stat2 = stat(file_name2)
+
+    if path.samefile(file_name1, file_name2):
+        if verbose:
+            hash = xxh3(file_name1, algorithm, io_mode, mmap_threshold)
+        else:
+            hash = f"inode:{file_stat1.st_ino}"
+        return True, hash, hash
+
+    if file_stat1.st_size != file_stat2.st_size and not verbose:
+        return (False, f"size:{file_stat1.st_size}",
+                f"size:{file_stat2.st_size}")
+
+    hash_object1 = HASH_ALGORITHMS[algorithm]()
+    hash_object2 = HASH_ALGORITHMS[algorithm]()
+    difference_offset: int | None = None
+    offset = 0
+
+    with open(file_name1, "rb") as f1, open(file_name2, "rb") as f2:
+        while True:
+            chunk1 = f1.read(COMPARE_BUFFER_SIZE)
+            chunk2 = f2.read(COMPARE_BUFFER_SIZE)
+            if chunk1 != chunk2 and difference_offset is None:
+                difference_offset = offset + find_first_difference(
+                    chunk1, chunk2)
+                if not verbose:
+                    break
+            if not chunk1 and not chunk2:
+                break
+            hash_object1.update(chunk1)
+            if verbose:
+                hash_object2.update(chunk2)
+            offset += COMPARE_BUFFER_SIZE
+
+    if difference_offset is None:
+        hash = format_digest(algorithm, hash_object1.hexdigest())
+        return True, hash, hash
+    if verbose:
+        return (False, format_digest(algorithm, hash_object1.hexdigest()),
+                format_digest(algorithm, hash_object2.hexdigest()))
+    return (False, f"offset:{difference_offset}",
+            f"offset:{difference_offset}")
+
+
+def get_block_map(
+    file_name: str, hash_cache: Mapping[str, CacheEntry], args
+) -> tuple[str, tuple[str, ...], bool]:
+    file_full_path = path.abspath(file_name)
+    cache_entry = hash_cache.get(file_full_path)
+    if (cache_entry and cache_entry.blocks and
+            is_cache_entry_current(cache_entry, stat(file_full_path))):
+        return cache_entry.digest, cache_entry.blocks, True
+
+    block_maps: dict[str, tuple[str, ...]] = {}
+    hash = tree_hash(file_full_path, args.algorithm, args.block_size,
+                     max(args.jobs // 2, 1), block_maps, hash_cache)
+    return hash, block_maps[file_full_path], False
+
+
+def find_block_differences(
+    blocks1: tuple[str, ...],
+    blocks2: tuple[str, ...],
+    file_size: int,
+    block_size: int
+) -> list[tuple[int, int]]:
+    differences: list[tuple[int, int]] = []
+    for index in range(max(len(blocks1), len(blocks2))):
+        if blocks1[index:index + 1] == blocks2[index:index + 1]:
+            continue
+        start = index * block_size
+        end = min(start + block_size, file_size)
+        if differences and differences[-1][1] == start:
+            differences[-1] = (differences[-1][0], end)
+        else:
+            differences.append((start, end))
+    return differences
 
 
 def show_file_comparison(args) -> None:
-    hash1: str = xxh3(args.path1)
-    hash2: str = xxh3(args.path2)
+    blocks1: tuple[str, ...] = ()
+    blocks2: tuple[str, ...] = ()
+    if args.blocks:
+        hash_cache: MutableMapping[str, CacheEntry] = {}
+        file_stats = {path.abspath(file_name): stat(file_name)
+                      for file_name in (args.path1, args.path2)}
+        if args.cache_file or args.update_cache:
+            hash_cache = load_hash_cache(args, [args.path1, args.path2])
+
+        if args.cache_db:
+            cache_database = open_cache_database(args.cache_db)
+            for file_full_path, file_stat in file_stats.items():
+                database_entry = get_cache_database_entry(
+                    cache_database, file_full_path, get_digest_tag(args))
+                cache_entry = hash_cache.get(file_full_path)
+                if database_entry and not (
+                        cache_entry and
+                        is_cache_entry_current(cache_entry, file_stat)):
+                    hash_cache[file_full_path] = database_entry
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            (hash1, blocks1, cached1), (hash2, blocks2, cached2) = (
+                executor.map(
+                    partial(get_block_map, hash_cache=hash_cache, args=args),
+                    (args.path1, args.path2)))
+        redundant = hash1 == hash2
+
+        updated_block_maps = {
+            path.abspath(file_name): (hash, blocks)
+            for file_name, hash, blocks, cached in (
+                (args.path1, hash1, blocks1, cached1),
+                (args.path2, hash2, blocks2, cached2))
+            if not cached}
+        if args.cache_db:
+            update_cache_database(
+                cache_database, get_digest_tag(args),
+                [(file_full_path, CacheEntry(
+                    hash, blocks, file_stats[file_full_path].st_size,
+                    file_stats[file_full_path].st_mtime_ns,
+                    file_stats[file_full_path].st_ino,
+                    file_stats[file_full_path].st_dev))
+                 for file_full_path, (hash, blocks)
+                 in updated_block_maps.items()])
+            cache_database.close()
+        if args.update_cache:
+            append_hash_cache(args.update_cache, [
+                format_hash_line(
+                    hash, get_cache_path(file_full_path, args.cache_root),
+                    blocks, file_stat=file_stats[file_full_path])
+                for file_full_path, (hash, blocks)
+                in updated_block_maps.items()])
+    else:
+        redundant, hash1, hash2 = compare_files(
+            args.path1, args.path2, args.verbose, args.algorithm,
+            args.io_mode, args.mmap_threshold)
 
     if args.verbose:
-        print(f"{hash1} '{path.abspath(args.path1)}'")
-        print(f"{hash2} '{path.abspath(args.path2)}'")
+        print(format_hash_line(hash1, path.abspath(args.path1), blocks1,
+                               file_stat=stat(args.path1)))
+        print(format_hash_line(hash2, path.abspath(args.path2), blocks2,
+                               file_stat=stat(args.path2)))
 
-    if hash1 == hash2:
+    if redundant:
         if args.path1 != args.path2:
             print(
                 (f"={hash1} ['{path.abspath(args.path1)}', "
@@ -144,35 +1773,41 @@ def show_file_comparison(args) -> None:
     else:
         print(f"<{hash1} '{path.abspath(args.path1)}'")
         print(f">{hash2} '{path.abspath(args.path2)}'")
+        if args.blocks:
+            for start, end in find_block_differences(
+                blocks1, blocks2,
+                max(stat(args.path1).st_size, stat(args.path2).st_size),
+                args.block_size
+            ):
+                print(f"!{start}-{end - 1}")
         raise SystemExit(1)
 
 
 def show_directory_comparison(args) -> None:
     content_redundancy: bool = True
-    dict_path1: dict[str, list[str]] = get_hash_dict(args.path1, args)
-    dict_path2: dict[str, list[str]] = get_hash_dict(args.path2, args)
+    index1, index2 = get_hash_dicts([args.path1, args.path2], args)
 
-    for key in dict_path1:
-        if len(dict_path1[key]) > 1:
-            print("{" + f"{key} {dict_path1[key]}")
+    for key, file_paths in index1.items():
+        if len(file_paths) > 1:
+            print("{" + f"{key} {file_paths}")
 
-    for key in dict_path2:
-        if len(dict_path2[key]) > 1:
-            print("}" + f"{key} {dict_path2[key]}")
+    for key, file_paths in index2.items():
+        if len(file_paths) > 1:
+            print("}" + f"{key} {file_paths}")
 
-    for key in dict_path1:
-        if key not in dict_path2:
+    for key, file_paths in index1.items():
+        if key not in index2:
             content_redundancy = False
-            for not_redundant_file in dict_path1[key]:
+            for not_redundant_file in file_paths:
                 print(f"<{key} '{not_redundant_file}'")
 
-    for key in dict_path2:
-        if key not in dict_path1:
+    for key, file_paths in index2.items():
+        if key not in index1:
             content_redundancy = False
-            for not_redundant_file in dict_path2[key]:
+            for not_redundant_file in file_paths:
                 print(f">{key} '{not_redundant_file}'")
         else:
-            print(f"={key} {dict_path1[key] + dict_path2[key]}")
+            print(f"={key} {index1[key] + file_paths}")
 
     if content_redundancy:
         print("=input directories are redundant")
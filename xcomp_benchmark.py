@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+import argparse
+from functools import partial
+from os import mkdir
+from os import path
+from os import urandom
+from re import findall
+from re import search
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from tracemalloc import get_traced_memory
+from tracemalloc import start as start_tracing
+from tracemalloc import stop as stop_tracing
+
+import xcomp
+
+MIB = 1024 * 1024
+
+
+def benchmark_algorithms(args) -> None:
+    large_chunk = urandom(MIB)
+    small_chunk = large_chunk[:args.small_size]
+    small_count = args.size * MIB // args.small_size
+
+    print(f"{'algorithm':<10} {'1 MiB chunks':>14} "
+          f"{f'{args.small_size} B inputs':>14}")
+    for algorithm, constructor in xcomp.HASH_ALGORITHMS.items():
+        hash_object = constructor()
+        start = perf_counter()
+        for _ in range(args.size):
+            hash_object.update(large_chunk)
+        hash_object.hexdigest()
+        large_elapsed = perf_counter() - start
+
+        start = perf_counter()
+        for _ in range(small_count):
+            constructor(small_chunk).hexdigest()
+        small_elapsed = perf_counter() - start
+
+        print(f"{algorithm:<10} {args.size / large_elapsed:>9.1f} MB/s "
+              f"{args.size / small_elapsed:>9.1f} MB/s")
+
+
+def legacy_xxh3(file_name: str) -> str:
+    hash_object = xcomp.xxh64()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(1024), b""):
+            hash_object.update(chunk)
+    return hash_object.hexdigest()
+
+
+def measure_read_path(
+    function, file_names: list[str], total_size: int
+) -> str:
+    start = perf_counter()
+    for file_name in file_names:
+        function(file_name)
+    elapsed = perf_counter() - start
+    return f"{total_size / MIB / elapsed:>9.1f} MB/s"
+
+
+def benchmark_read(args) -> None:
+    with TemporaryDirectory() as directory:
+        large_file = path.join(directory, "large")
+        with open(large_file, "wb") as f:
+            for _ in range(args.size):
+                f.write(urandom(MIB))
+
+        small_files: list[str] = []
+        for index in range(args.small_files):
+            small_files.append(path.join(directory, f"small{index}"))
+            with open(small_files[-1], "wb") as f:
+                f.write(urandom(args.small_size))
+
+        large_total = args.size * MIB
+        small_total = args.small_files * args.small_size
+        print(f"{'read path':<10} {f'{args.size} MiB file':>14} "
+              f"{f'{args.small_size} B files':>14}")
+        for name, function in (("legacy", legacy_xxh3),
+                               ("readinto", xcomp.xxh3),
+                               ("mmap", partial(xcomp.xxh3, io_mode="mmap"))):
+            print(f"{name:<10} "
+                  f"{measure_read_path(function, [large_file], large_total)} "
+                  f"{measure_read_path(function, small_files, small_total)}")
+
+
+def benchmark_files(args) -> None:
+    with TemporaryDirectory() as directory:
+        file_names: list[str] = []
+        for index in range(args.files):
+            subdirectory = path.join(directory, str(index // 1000))
+            if index % 1000 == 0:
+                mkdir(subdirectory)
+            file_names.append(path.join(subdirectory, str(index)))
+            with open(file_names[-1], "wb") as f:
+                f.write(urandom(args.small_size))
+
+        print(f"{'executor':<10} {'jobs':>4} {'files/s':>12}")
+        for executor, jobs in (("serial", 1),
+                               ("thread", args.jobs),
+                               ("process", args.jobs)):
+            start = perf_counter()
+            xcomp.hash_files(file_names, xcomp.xxh3, jobs, executor)
+            elapsed = perf_counter() - start
+            print(f"{executor:<10} {jobs:>4} {args.files / elapsed:>12.0f}")
+
+
+def legacy_load_hash_cache(file_name: str) -> dict[str, xcomp.CacheEntry]:
+    hash_cache: dict[str, xcomp.CacheEntry] = {}
+    with open(file_name, "rt") as file_object:
+        for line in file_object:
+            match = search(
+                "(?:([a-z0-9_-]+):)?([a-f0-9]{16,128})[ \t]+'?([^'\n]+)'?",
+                line)
+            if match:
+                fields = dict(findall(" (size|mtime_ns|blocks)=([a-f0-9,]+)",
+                                      line[match.end():]))
+                hash_cache[path.abspath(match.group(3))] = xcomp.CacheEntry(
+                    match.group(2), (),
+                    int(fields["size"]) if "size" in fields else None,
+                    int(fields["mtime_ns"]) if "mtime_ns" in fields else None)
+    return hash_cache
+
+
+def benchmark_cache(args) -> None:
+    roots = [f"/data/{index:03}" for index in range(args.roots)]
+
+    print(f"{'lines':>10} {'legacy':>10} {'split':>10} "
+          f"{f'{args.roots} roots':>10}")
+    with TemporaryDirectory() as directory:
+        for lines in args.lines:
+            cache_file = path.join(directory, f"{lines}.txt")
+            with open(cache_file, "wt") as f:
+                for start in range(0, lines, 100000):
+                    f.write("".join(
+                        f"{index * 2654435761 % 2 ** 64:016x} "
+                        f"'/data/{index % args.directories:03}/"
+                        f"{index // args.directories}' "
+                        f"size={index} mtime_ns={index * 1000}\n"
+                        for index in range(start, min(start + 100000, lines))
+                    ))
+            cache_args = xcomp.read_arguments(
+                ["--cache_file", cache_file, "/data", "/data"])
+
+            elapsed: list[float] = []
+            for function in (partial(legacy_load_hash_cache, cache_file),
+                             partial(xcomp.load_hash_cache, cache_args),
+                             partial(xcomp.load_hash_cache, cache_args,
+                                     roots)):
+                start = perf_counter()
+                function()
+                elapsed.append(perf_counter() - start)
+            print(f"{lines:>10} "
+                  + " ".join(f"{seconds:>9.2f}s" for seconds in elapsed))
+
+
+def build_result_dict(args) -> dict[str, list[str]]:
+    result_dict: dict[str, list[str]] = {}
+    for index in range(args.files):
+        hash = f"{index % args.unique * 2654435761 % 2 ** 64:016x}"
+        file_full_path = f"/data/{index // 1000:05}/file{index % 1000}"
+        if hash in result_dict:
+            result_dict[hash].append(file_full_path)
+        else:
+            result_dict[hash] = [file_full_path]
+    return result_dict
+
+
+def build_hash_index(args) -> xcomp.HashIndex:
+    hash_index = xcomp.HashIndex()
+    for index in range(args.files):
+        hash_index.add(f"{index % args.unique * 2654435761 % 2 ** 64:016x}",
+                       f"/data/{index // 1000:05}/file{index % 1000}")
+    hash_index.freeze()
+    return hash_index
+
+
+def benchmark_index(args) -> None:
+    print(f"{'structure':<10} {'bytes/file':>10} {'peak/file':>10}")
+    for name, function in (("dict", build_result_dict),
+                           ("index", build_hash_index)):
+        start_tracing()
+        result = function(args)
+        current, peak = get_traced_memory()
+        stop_tracing()
+        del result
+        print(f"{name:<10} {current / args.files:>10.1f} "
+              f"{peak / args.files:>10.1f}")
+
+
+def benchmark_scan(args) -> None:
+    with TemporaryDirectory() as directory:
+        roots = [path.join(directory, name) for name in ("tree1", "tree2")]
+        for root in roots:
+            mkdir(root)
+            for index in range(args.files):
+                subdirectory = path.join(root, str(index // 1000))
+                if index % 1000 == 0:
+                    mkdir(subdirectory)
+                with open(path.join(subdirectory, str(index)), "wb") as f:
+                    f.write(b"x" * (index % args.sizes))
+
+        scan_args = xcomp.read_arguments(["--recursive", *roots])
+        files = 2 * args.files
+        start_tracing()
+        start = perf_counter()
+        result = xcomp.get_hash_dicts(roots, scan_args)
+        elapsed = perf_counter() - start
+        current, peak = get_traced_memory()
+        stop_tracing()
+        del result
+        print(f"{'files':>10} {'bytes/file':>10} {'peak/file':>10} "
+              f"{'seconds':>8}")
+        print(f"{files:>10} {current / files:>10.1f} {peak / files:>10.1f} "
+              f"{elapsed:>8.2f}")
+
+
+def read_arguments():
+    arg_parser = argparse.ArgumentParser(
+        prog="xcomp_benchmark",
+        description="Micro-benchmarks for the xcomp hashing engine.",
+        epilog="written by Rodrigo Viana Rocha"
+    )
+    subparsers = arg_parser.add_subparsers(dest="benchmark", required=True)
+
+    algorithms_parser = subparsers.add_parser(
+        "algorithms",
+        help="report the throughput of every hash algorithm backend"
+    )
+    algorithms_parser.add_argument(
+        "--size",
+        default=256,
+        type=int,
+        help="amount of data hashed per algorithm, in MiB (default: 256)"
+    )
+    algorithms_parser.add_argument(
+        "--small-size",
+        default=4096,
+        type=int,
+        help=("size in bytes of each input of the small file run "
+              "(default: 4096)")
+    )
+    algorithms_parser.set_defaults(function=benchmark_algorithms)
+
+    read_parser = subparsers.add_parser(
+        "read",
+        help=("compare the readinto and mmap hashing paths with the former "
+              "1 KiB read loop")
+    )
+    read_parser.add_argument(
+        "--size",
+        default=512,
+        type=int,
+        help="size of the large file, in MiB (default: 512)"
+    )
+    read_parser.add_argument(
+        "--small-files",
+        default=10000,
+        type=int,
+        help="number of small files (default: 10000)"
+    )
+    read_parser.add_argument(
+        "--small-size",
+        default=4096,
+        type=int,
+        help="size in bytes of each small file (default: 4096)"
+    )
+    read_parser.set_defaults(function=benchmark_read)
+
+    files_parser = subparsers.add_parser(
+        "files",
+        help=("compare the serial, thread and process hashing backends on "
+              "a synthetic tree of small files")
+    )
+    files_parser.add_argument(
+        "--files",
+        default=1000000,
+        type=int,
+        help="number of files in the synthetic tree (default: 1000000)"
+    )
+    files_parser.add_argument(
+        "--small-size",
+        default=512,
+        type=int,
+        help="size in bytes of each file (default: 512)"
+    )
+    files_parser.add_argument(
+        "--jobs",
+        default=xcomp.default_jobs(),
+        type=int,
+        help=("number of thread and process workers (default: the number "
+              "of CPUs available)")
+    )
+    files_parser.set_defaults(function=benchmark_files)
+
+    cache_parser = subparsers.add_parser(
+        "cache",
+        help=("compare the load time of the former regex cache parser with "
+              "the split-based one, with and without filtering by roots")
+    )
+    cache_parser.add_argument(
+        "--lines",
+        default=[1000000, 10000000, 30000000],
+        nargs="+",
+        type=int,
+        help=("number of lines of each synthetic cache file (default: "
+              "1000000 10000000 30000000)")
+    )
+    cache_parser.add_argument(
+        "--directories",
+        default=100,
+        type=int,
+        help=("number of top-level directories the cached paths are spread "
+              "over (default: 100)")
+    )
+    cache_parser.add_argument(
+        "--roots",
+        default=2,
+        type=int,
+        help=("number of those directories passed as roots to the loader "
+              "(default: 2)")
+    )
+    cache_parser.set_defaults(function=benchmark_cache)
+
+    index_parser = subparsers.add_parser(
+        "index",
+        help=("compare the memory used per file by a dict of path lists and "
+              "by the compact hash index")
+    )
+    index_parser.add_argument(
+        "--files",
+        default=1000000,
+        type=int,
+        help="number of synthetic files (default: 1000000)"
+    )
+    index_parser.add_argument(
+        "--unique",
+        default=900000,
+        type=int,
+        help="number of distinct digests among them (default: 900000)"
+    )
+    index_parser.set_defaults(function=benchmark_index)
+
+    scan_parser = subparsers.add_parser(
+        "scan",
+        help=("report the memory used per file by get_hash_dicts end to end "
+              "on two identical synthetic trees")
+    )
+    scan_parser.add_argument(
+        "--files",
+        default=100000,
+        type=int,
+        help="number of files in each tree (default: 100000)"
+    )
+    scan_parser.add_argument(
+        "--sizes",
+        default=5000,
+        type=int,
+        help=("number of distinct file sizes, so that files of the same "
+              "size go through the partial and full stages (default: 5000)")
+    )
+    scan_parser.set_defaults(function=benchmark_scan)
+
+    return arg_parser.parse_args()
+
+
+def main() -> None:
+    args = read_arguments()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
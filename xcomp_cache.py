@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import argparse
+
+import xcomp
+
+
+def shard_cache(args) -> None:
+    shards = xcomp.shard_hash_cache(args.cache_files, args.directory,
+                                    args.depth)
+    print(f"xcomp_cache: {shards} shard(s) written to {args.directory}")
+
+
+def pack_cache(args) -> None:
+    entries = xcomp.pack_hash_cache(args.cache_files, args.packed_cache,
+                                    args.tag)
+    print(f"xcomp_cache: {entries} entries packed into {args.packed_cache}")
+
+
+def unpack_cache(args) -> None:
+    entries = xcomp.unpack_hash_cache(args.packed_cache, args.cache_file)
+    print(f"xcomp_cache: {entries} entries written to {args.cache_file}")
+
+
+def read_arguments():
+    arg_parser = argparse.ArgumentParser(
+        prog="xcomp_cache",
+        description="Maintenance commands for xcomp hash cache files.",
+        epilog="written by Rodrigo Viana Rocha"
+    )
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+
+    shard_parser = subparsers.add_parser(
+        "shard",
+        help=("split plain text cache files into one shard per directory "
+              "prefix plus a manifest, usable as a --cache_file directory")
+    )
+    shard_parser.add_argument(
+        "cache_files",
+        nargs="+",
+        help="plain text cache files to split, later lines taking precedence"
+    )
+    shard_parser.add_argument(
+        "directory",
+        help="directory the shards and their manifest are written to"
+    )
+    shard_parser.add_argument(
+        "--depth",
+        default=1,
+        type=int,
+        help=("number of leading directories of each cached path that "
+              "select its shard (default: 1)")
+    )
+    shard_parser.set_defaults(function=shard_cache)
+
+    pack_parser = subparsers.add_parser(
+        "pack",
+        help=("convert plain text cache files into a binary cache sorted by "
+              "path hash, which xcomp memory-maps instead of parsing")
+    )
+    pack_parser.add_argument(
+        "cache_files",
+        nargs="+",
+        help="plain text cache files to pack, later lines taking precedence"
+    )
+    pack_parser.add_argument(
+        "packed_cache",
+        help="binary cache file to write"
+    )
+    pack_parser.add_argument(
+        "--tag",
+        default=xcomp.DEFAULT_ALGORITHM,
+        help=("digest tag of the entries to pack, such as xxh3_64 or "
+              f"xxh64-tree-{xcomp.TREE_BLOCK_SIZE} "
+              f"(default: {xcomp.DEFAULT_ALGORITHM})")
+    )
+    pack_parser.set_defaults(function=pack_cache)
+
+    unpack_parser = subparsers.add_parser(
+        "unpack",
+        help="convert a binary cache back into a plain text cache file"
+    )
+    unpack_parser.add_argument(
+        "packed_cache",
+        help="binary cache file to read"
+    )
+    unpack_parser.add_argument(
+        "cache_file",
+        help="plain text cache file to write"
+    )
+    unpack_parser.set_defaults(function=unpack_cache)
+
+    return arg_parser.parse_args()
+
+
+def main() -> None:
+    args = read_arguments()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
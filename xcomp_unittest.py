@@ -1,6 +1,18 @@
+import fcntl
+import resource
+import tempfile
 import unittest
 import xcomp
 from io import StringIO
+from os import makedev
+from os import makedirs
+from os import listdir
+from os import path
+from os import link
+from os import symlink
+from os import truncate
+from threading import Thread
+from time import sleep
 from unittest.mock import patch
 
 
@@ -12,13 +24,45 @@ class Arguments:
         path2: str,
         cache_file: list[str] | None = None,
         recursive: bool | None = None,
-        verbose: bool | None = None
+        verbose: bool | None = None,
+        stages: list[str] | None = None,
+        sample_size: int = 4096,
+        algorithm: str = xcomp.DEFAULT_ALGORITHM,
+        io_mode: str = "read",
+        mmap_threshold: int = xcomp.MMAP_THRESHOLD,
+        jobs: int = 1,
+        executor: str = "thread",
+        hdd_jobs: int = 1,
+        order: str = "walk",
+        reflinks: bool = False,
+        tree_hash: bool = False,
+        block_size: int = xcomp.TREE_BLOCK_SIZE,
+        blocks: bool = False,
+        cache_db: str | None = None,
+        update_cache: str | None = None,
+        cache_root: str | None = None
     ):
         self.path1 = path1
         self.path2 = path2
         self.cache_file = cache_file
         self.recursive = recursive
         self.verbose = verbose
+        self.stages = stages or list(xcomp.STAGES)
+        self.sample_size = sample_size
+        self.algorithm = algorithm
+        self.io_mode = io_mode
+        self.mmap_threshold = mmap_threshold
+        self.jobs = jobs
+        self.executor = executor
+        self.hdd_jobs = hdd_jobs
+        self.order = order
+        self.reflinks = reflinks
+        self.tree_hash = tree_hash
+        self.block_size = block_size
+        self.blocks = blocks
+        self.cache_db = cache_db
+        self.update_cache = update_cache
+        self.cache_root = cache_root
 
 
 class Tests(unittest.TestCase):
@@ -58,6 +102,859 @@ class Tests(unittest.TestCase):
             xcomp.main(args)
             self.assertEqual(xcomp_out.getvalue(), result)
 
+    def test_unique_sizes_are_not_hashed(self):
+        args = Arguments(
+            'fixtures/directory4',
+            'fixtures/directory5',
+            recursive=True
+        )
+        with patch('sys.stdout', new=StringIO()) as xcomp_out, \
+                patch('xcomp.xxh3') as xxh3:
+            xcomp.main(args)
+            xxh3.assert_not_called()
+            self.assertEqual(
+                xcomp_out.getvalue(),
+                (f"<size:57 '{path.abspath('fixtures/directory4/filee1')}'\n"
+                 f">size:49 '{path.abspath('fixtures/directory5/file1')}'\n")
+            )
+
+    def test_shared_sizes_are_hashed(self):
+        args = Arguments(
+            'fixtures/directory3',
+            'fixtures/directory4',
+            recursive=True
+        )
+        with patch('sys.stdout', new=StringIO()) as xcomp_out:
+            xcomp.main(args)
+            self.assertTrue(
+                xcomp_out.getvalue().endswith(
+                    "=input directories are redundant\n")
+            )
+
+    def test_partial_stage_separates_same_size_files(self):
+        args = Arguments(
+            'fixtures/directory1/subdir1',
+            'fixtures/directory2/subdir1',
+            sample_size=4
+        )
+        with patch('sys.stdout', new=StringIO()) as xcomp_out, \
+                patch('xcomp.xxh3', wraps=xcomp.xxh3) as xxh3:
+            xcomp.main(args)
+            hashed = [call.args[0] for call in xxh3.call_args_list]
+            self.assertNotIn(path.abspath('fixtures/directory1/subdir1/z'),
+                             hashed)
+            self.assertNotIn(path.abspath('fixtures/directory2/subdir1/w'),
+                             hashed)
+            self.assertIn("<partial:", xcomp_out.getvalue())
+
+    def test_full_stage_only(self):
+        args = Arguments(
+            'fixtures/directory4',
+            'fixtures/directory5',
+            stages=["full"]
+        )
+        with patch('sys.stdout', new=StringIO()) as xcomp_out:
+            xcomp.main(args)
+            self.assertNotIn("size:", xcomp_out.getvalue())
+
+    def test_stages_require_full(self):
+        with self.assertRaises(xcomp.argparse.ArgumentTypeError):
+            xcomp.parse_stages("size,partial")
+
+    def test_different_single_files_are_not_hashed(self):
+        args = Arguments(
+            'fixtures/directory1/file2',
+            'fixtures/directory1/file4'
+        )
+        with patch('sys.stdout', new=StringIO()) as xcomp_out, \
+                patch('xcomp.xxh3') as xxh3:
+            with self.assertRaises(SystemExit):
+                xcomp.main(args)
+            xxh3.assert_not_called()
+            self.assertTrue(xcomp_out.getvalue().startswith("<offset:4 "))
+
+    def test_first_different_byte_is_reported(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file1 = path.join(directory, "file1")
+            file2 = path.join(directory, "file2")
+            with open(file1, "wb") as f:
+                f.write(b"x" * 100000)
+            with open(file2, "wb") as f:
+                f.write(b"x" * 99999 + b"y")
+            self.assertEqual(xcomp.compare_files(file1, file2, False),
+                             (False, "offset:99999", "offset:99999"))
+            with patch('xcomp.COMPARE_BUFFER_SIZE', 4096):
+                self.assertEqual(xcomp.compare_files(file1, file2, False),
+                                 (False, "offset:99999", "offset:99999"))
+        self.assertEqual(xcomp.find_first_difference(b"abc", b"abd"), 2)
+        self.assertEqual(xcomp.find_first_difference(b"ab", b"abc"), 2)
+
+    def test_different_single_file_sizes(self):
+        args = Arguments(
+            'fixtures/directory1/file1',
+            'fixtures/directory1/file2'
+        )
+        with patch('sys.stdout', new=StringIO()) as xcomp_out:
+            with self.assertRaises(SystemExit):
+                xcomp.main(args)
+            self.assertTrue(xcomp_out.getvalue().startswith("<size:20 "))
+
+    def test_different_single_files_verbose(self):
+        args = Arguments(
+            'fixtures/directory1/file2',
+            'fixtures/directory1/file4',
+            verbose=True
+        )
+        with patch('sys.stdout', new=StringIO()) as xcomp_out:
+            with self.assertRaises(SystemExit):
+                xcomp.main(args)
+            self.assertIn(">b934de79df15dc7a ", xcomp_out.getvalue())
+
+    def test_tagged_hexdigest(self):
+        self.assertEqual(
+            xcomp.xxh3('./fixtures/directory1/file1', 'xxh3_64'),
+            "xxh3_64:" + xcomp.xxh3_64(
+                b"This file is unique.").hexdigest()
+        )
+
+    def test_cache_ignores_other_algorithms(self):
+        file1 = path.abspath('fixtures/directory1/file1')
+        file2 = path.abspath('fixtures/directory1/file2')
+        with tempfile.NamedTemporaryFile("wt", suffix=".txt") as cache:
+            cache.write(f"0123456789abcdef '{file1}'\n"
+                        f"xxh3_64:0123456789abcdef '{file2}'\n")
+            cache.flush()
+            args = Arguments('.', '.', cache_file=[cache.name],
+                             algorithm='xxh3_64')
+            self.assertEqual(
+                xcomp.load_hash_cache(args),
+                {file2: xcomp.CacheEntry("xxh3_64:0123456789abcdef")}
+            )
+
+    def test_hexdigest_with_small_read_buffer(self):
+        with patch('xcomp.READ_BUFFER_SIZE', 8), \
+                patch('xcomp.thread_state', xcomp.threading.local()):
+            for _ in range(2):
+                self.assertEqual(
+                    xcomp.xxh3('./fixtures/directory1/file1'),
+                    "8bb820c8bfd319e9"
+                )
+
+    def test_mmap_hexdigest(self):
+        for io_mode in ("mmap", "auto"):
+            self.assertEqual(
+                xcomp.xxh3('./fixtures/directory1/file1', io_mode=io_mode,
+                           mmap_threshold=0),
+                "8bb820c8bfd319e9"
+            )
+
+    def test_mmap_file_truncated_while_hashing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = path.join(directory, "file")
+            with open(file_name, "wb") as f:
+                f.write(b"x" * 3 * 4096)
+            with open(file_name, "rb") as f:
+                try:
+                    fcntl.fcntl(f.fileno(), fcntl.F_SETLEASE, fcntl.F_RDLCK)
+                except (AttributeError, OSError):
+                    self.skipTest("read leases are not supported here")
+                fcntl.fcntl(f.fileno(), fcntl.F_SETLEASE, fcntl.F_UNLCK)
+
+            truncation = Thread(target=truncate, args=(file_name, 0))
+            mapped_files = []
+            hash_mapped_file = xcomp.hash_mapped_file
+
+            def hash_leased_file(f, hash_object, file_size):
+                mapped_files.append(f)
+                return hash_mapped_file(f, hash_object, file_size)
+
+            class TruncatingHash:
+                def __init__(self):
+                    self.hash_object = xcomp.xxh64()
+                    if truncation.ident:
+                        truncation.join()
+
+                def update(self, data):
+                    if not truncation.ident:
+                        truncation.start()
+                        lease_file = mapped_files[0].fileno()
+                        for _ in range(5000):
+                            lease = fcntl.fcntl(lease_file, fcntl.F_GETLEASE)
+                            if lease != fcntl.F_RDLCK:
+                                break
+                            sleep(0.001)
+                    self.hash_object.update(data)
+
+                def hexdigest(self):
+                    return self.hash_object.hexdigest()
+
+            with patch('xcomp.MMAP_SLICE_SIZE', 4096), \
+                    patch('xcomp.hash_mapped_file', hash_leased_file), \
+                    patch.dict('xcomp.HASH_ALGORITHMS',
+                               {'truncating': TruncatingHash}):
+                self.assertEqual(
+                    xcomp.xxh3(file_name, 'truncating', 'mmap'),
+                    "truncating:" + xcomp.xxh64(b"").hexdigest()
+                )
+            self.assertTrue(mapped_files)
+
+    def test_parallel_hashing_is_deterministic(self):
+        outputs = []
+        for jobs, executor in ((1, "thread"), (4, "thread"), (2, "process")):
+            args = Arguments(
+                'fixtures/directory1',
+                'fixtures/directory2',
+                recursive=True,
+                verbose=True,
+                jobs=jobs,
+                executor=executor
+            )
+            with patch('sys.stdout', new=StringIO()) as xcomp_out:
+                xcomp.main(args)
+                outputs.append(xcomp_out.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
+    def test_process_batches_keep_tagged_digests(self):
+        file_names = ['fixtures/directory1/file1', 'fixtures/directory1/file2',
+                      'fixtures/directory1/file4']
+        hash_function = xcomp.partial(xcomp.xxh3, algorithm='xxh3_128')
+        with patch('xcomp.PROCESS_BATCH_SIZE', 2):
+            self.assertEqual(
+                xcomp.hash_files(file_names, hash_function, 2, "process"),
+                [hash_function(file_name) for file_name in file_names]
+            )
+
+    def test_devices_are_hashed_concurrently(self):
+        barrier = xcomp.threading.Barrier(2, timeout=5)
+
+        def hash_function(file_name):
+            barrier.wait()
+            return file_name.upper()
+
+        file_stats = {
+            "a": xcomp.stat_result((0, 0, 1, 0, 0, 0, 0, 0, 0, 0)),
+            "b": xcomp.stat_result((0, 0, 2, 0, 0, 0, 0, 0, 0, 0)),
+        }
+        with patch('xcomp.is_rotational', return_value=False):
+            self.assertEqual(
+                xcomp.hash_device_files(
+                    {"a": None, "b": None}, file_stats, hash_function,
+                    Arguments('.', '.')
+                ),
+                {"a": "A", "b": "B"}
+            )
+
+    def test_rotational_devices_use_hdd_jobs(self):
+        file_stats = {"a": xcomp.stat_result((0, 0, 1, 0, 0, 0, 0, 0, 0, 0))}
+        with patch('xcomp.is_rotational', return_value=True), \
+                patch('xcomp.hash_files', return_value=["A"]) as hash_files:
+            xcomp.hash_device_files({"a": None}, file_stats, str.upper,
+                                    Arguments('.', '.', jobs=8, hdd_jobs=2))
+            self.assertEqual(hash_files.call_args.args[2], 2)
+
+    def test_tree_hash_blocks_share_the_device_jobs(self):
+        args = Arguments('fixtures/directory1', 'fixtures/directory2',
+                         tree_hash=True, block_size=8, jobs=8, hdd_jobs=1)
+        with patch('sys.stdout', new=StringIO()), \
+                patch('xcomp.is_rotational', return_value=True), \
+                patch('xcomp.tree_hash', wraps=xcomp.tree_hash) as tree_hash:
+            xcomp.main(args)
+            self.assertTrue(tree_hash.call_args_list)
+            self.assertEqual(
+                {call.kwargs["jobs"] for call in tree_hash.call_args_list},
+                {1})
+
+    def test_block_size_must_be_positive(self):
+        with patch('sys.argv', ['xcomp', '.', '.', '--block-size', '0']), \
+                patch('sys.stderr', new=StringIO()):
+            with self.assertRaises(SystemExit):
+                xcomp.read_arguments()
+
+    def test_sample_size_must_be_positive(self):
+        with patch('sys.stderr', new=StringIO()):
+            with self.assertRaises(SystemExit):
+                xcomp.read_arguments(['.', '.', '--sample-size', '-5'])
+
+    def test_is_rotational_reads_the_parent_queue(self):
+        with tempfile.TemporaryDirectory() as sysfs:
+            disk = path.join(sysfs, "devices", "sda")
+            makedirs(path.join(disk, "sda1"))
+            makedirs(path.join(disk, "queue"))
+            with open(path.join(disk, "queue", "rotational"), "wt") as f:
+                f.write("1\n")
+            symlink(path.join(disk, "sda1"), path.join(sysfs, "8:1"))
+
+            xcomp.is_rotational.cache_clear()
+            with patch('xcomp.SYSFS_DEVICE_PATH', sysfs):
+                self.assertTrue(xcomp.is_rotational(makedev(8, 1)))
+                self.assertFalse(xcomp.is_rotational(makedev(8, 2)))
+            xcomp.is_rotational.cache_clear()
+
+    def test_inode_order(self):
+        file_names = ["a", "b", "c"]
+        file_stats = {
+            "a": xcomp.stat_result((0, 30, 1, 0, 0, 0, 0, 0, 0, 0)),
+            "b": xcomp.stat_result((0, 10, 1, 0, 0, 0, 0, 0, 0, 0)),
+            "c": xcomp.stat_result((0, 20, 1, 0, 0, 0, 0, 0, 0, 0)),
+        }
+        xcomp.sort_device_files(file_names, file_stats, "inode")
+        self.assertEqual(file_names, ["b", "c", "a"])
+
+        extents = {"a": [(0, 100, 4096, 1)], "b": [(0, 300, 4096, 1)],
+                   "c": []}
+        with patch('xcomp.get_extents',
+                   side_effect=lambda file_name, _: extents[file_name]):
+            xcomp.sort_device_files(file_names, file_stats, "extent")
+        self.assertEqual(file_names, ["c", "a", "b"])
+
+        with patch('xcomp.get_extents', side_effect=OSError):
+            xcomp.sort_device_files(file_names, file_stats, "extent")
+        self.assertEqual(file_names, ["b", "c", "a"])
+
+    def test_hardlinks_are_hashed_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tree1 = path.join(directory, "tree1")
+            tree2 = path.join(directory, "tree2")
+            makedirs(tree1)
+            makedirs(tree2)
+            with open(path.join(tree1, "file"), "wt") as f:
+                f.write("hardlinked content")
+            with open(path.join(tree2, "other"), "wt") as f:
+                f.write("same size content!")
+            link(path.join(tree1, "file"), path.join(tree1, "link"))
+            link(path.join(tree1, "file"), path.join(tree2, "link"))
+
+            args = Arguments(tree1, tree2, verbose=True)
+            with patch('sys.stdout', new=StringIO()) as xcomp_out, \
+                    patch('xcomp.xxh3', wraps=xcomp.xxh3) as xxh3:
+                xcomp.main(args)
+                self.assertEqual(xxh3.call_count, 2)
+                self.assertIn("xcomp: 2 hardlink(s) to inodes already "
+                              "hashed, 36 bytes not reread",
+                              xcomp_out.getvalue())
+
+            args = Arguments(tree1, tree1)
+            with patch('sys.stdout', new=StringIO()) as xcomp_out, \
+                    patch('xcomp.xxh3') as xxh3:
+                xcomp.main(args)
+                xxh3.assert_not_called()
+                self.assertTrue(xcomp_out.getvalue().endswith(
+                    "=input directories are redundant\n"))
+
+    def test_reflinked_clones_are_not_hashed(self):
+        args = Arguments(
+            'fixtures/directory3',
+            'fixtures/directory4',
+            reflinks=True
+        )
+        with patch('sys.stdout', new=StringIO()) as xcomp_out, \
+                patch('xcomp.get_extents',
+                      return_value=[(0, 8192, 4096, 0x1 | 0x2000)]), \
+                patch('xcomp.xxh3') as xxh3:
+            xcomp.main(args)
+            xxh3.assert_not_called()
+            self.assertTrue(xcomp_out.getvalue().endswith(
+                "=input directories are redundant\n"))
+
+    def test_reflinks_fall_back_to_hashing(self):
+        args = Arguments(
+            'fixtures/directory3',
+            'fixtures/directory4',
+            reflinks=True
+        )
+        for extents in (OSError, [(0, 8192, 4096, 0x1 | 0x4 | 0x2000)],
+                        [(0, 8192, 4096, 0x1)]):
+            with patch('sys.stdout', new=StringIO()) as xcomp_out, \
+                    patch('xcomp.get_extents', side_effect=[extents] * 3), \
+                    patch('xcomp.xxh3', wraps=xcomp.xxh3) as xxh3:
+                xcomp.main(args)
+                self.assertEqual(xxh3.call_count, 3)
+                self.assertTrue(xcomp_out.getvalue().endswith(
+                    "=input directories are redundant\n"))
+
+    def test_tree_hash(self):
+        content = b"This file is unique."
+        blocks = [xcomp.xxh64(content[offset:offset + 8]).digest()
+                  for offset in range(0, len(content), 8)]
+        block_maps = {}
+        for jobs in (1, 3):
+            self.assertEqual(
+                xcomp.tree_hash('./fixtures/directory1/file1', block_size=8,
+                                jobs=jobs, block_maps=block_maps),
+                "xxh64-tree-8:" + xcomp.xxh64(b"".join(blocks)).hexdigest()
+            )
+        self.assertEqual(
+            block_maps['./fixtures/directory1/file1'],
+            tuple(block.hex() for block in blocks)
+        )
+
+    def test_cache_keeps_tree_block_digests(self):
+        file1 = path.abspath('fixtures/directory1/file1')
+        file2 = path.abspath('fixtures/directory1/file2')
+        with tempfile.NamedTemporaryFile("wt", suffix=".txt") as cache:
+            cache.write(f"0123456789abcdef '{file1}'\n"
+                        f"xxh64-tree-8:0123456789abcdef '{file2}' "
+                        "blocks=0000000000000001,0000000000000002\n")
+            cache.flush()
+            args = Arguments('.', '.', cache_file=[cache.name],
+                             tree_hash=True, block_size=8)
+            self.assertEqual(
+                xcomp.load_hash_cache(args),
+                {file2: xcomp.CacheEntry(
+                    "xxh64-tree-8:0123456789abcdef",
+                    ("0000000000000001", "0000000000000002"))}
+            )
+
+    def test_block_differences(self):
+        self.assertEqual(
+            xcomp.find_block_differences(
+                ("a", "b", "c", "d"), ("a", "x", "y", "d", "e"), 36, 8),
+            [(8, 24), (32, 36)]
+        )
+
+    def test_blocks_reuse_cached_block_map(self):
+        file2 = path.abspath('fixtures/directory1/file2')
+        file4 = path.abspath('fixtures/directory1/file4')
+        block_maps = {}
+        hash = xcomp.tree_hash(file2, block_size=8, block_maps=block_maps)
+        with tempfile.NamedTemporaryFile("wt", suffix=".txt") as cache:
+            cache.write(xcomp.format_hash_line(hash, file2, block_maps[file2]))
+            cache.flush()
+            args = Arguments(file2, file4, cache_file=[cache.name],
+                             block_size=8, blocks=True)
+            with patch('sys.stdout', new=StringIO()) as xcomp_out, \
+                    patch('xcomp.tree_hash', wraps=xcomp.tree_hash) as tree:
+                with self.assertRaises(SystemExit):
+                    xcomp.main(args)
+                self.assertEqual(tree.call_count, 1)
+                self.assertEqual(tree.call_args.args[0], file4)
+                self.assertTrue(xcomp_out.getvalue().endswith("\n!0-15\n"))
+
+    def test_blocks_store_computed_block_maps(self):
+        file2 = path.abspath('fixtures/directory1/file2')
+        file4 = path.abspath('fixtures/directory1/file4')
+        with tempfile.TemporaryDirectory() as directory:
+            for option in ({"update_cache": path.join(directory, "cache")},
+                           {"cache_db": path.join(directory, "cache.db")}):
+                args = Arguments(file2, file4, block_size=8, blocks=True,
+                                 **option)
+                outputs = []
+                for call_count in (2, 0):
+                    with patch('sys.stdout', new=StringIO()) as xcomp_out, \
+                            patch('xcomp.tree_hash',
+                                  wraps=xcomp.tree_hash) as tree:
+                        with self.assertRaises(SystemExit):
+                            xcomp.main(args)
+                        self.assertEqual(tree.call_count, call_count)
+                        outputs.append(xcomp_out.getvalue())
+                self.assertEqual(outputs[0], outputs[1])
+                self.assertTrue(outputs[1].endswith("\n!0-15\n"))
+
+    def test_sparse_files_skip_holes(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.truncate(8 * 1024 * 1024)
+            f.seek(3 * 1024 * 1024 + 5)
+            f.write(b"data between holes")
+            f.flush()
+            with open(f.name, "rb") as dense:
+                digest = xcomp.xxh64(dense.read()).hexdigest()
+
+            with patch('xcomp.preadv', wraps=xcomp.preadv) as preadv:
+                self.assertEqual(xcomp.xxh3(f.name), digest)
+                tree_digest = xcomp.tree_hash(f.name, block_size=1024 * 1024,
+                                              jobs=2)
+                sparse_reads = preadv.call_count
+            with patch('xcomp.is_sparse', return_value=False):
+                self.assertEqual(
+                    xcomp.tree_hash(f.name, block_size=1024 * 1024),
+                    tree_digest
+                )
+            if xcomp.is_sparse(xcomp.fstat(f.fileno())):
+                self.assertLess(sparse_reads, 8)
+
+    def test_tree_hash_resumes_appended_files(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"0123456789" * 4)
+            f.flush()
+            block_maps = {}
+            hash = xcomp.tree_hash(f.name, block_size=8,
+                                   block_maps=block_maps)
+            file_stat = xcomp.stat(f.name)
+            checkpoints = {f.name: xcomp.CacheEntry(
+                hash, block_maps[f.name], file_stat.st_size,
+                file_stat.st_mtime_ns)}
+
+            f.write(b"appended to the log")
+            f.flush()
+            with patch('xcomp.hash_block', wraps=xcomp.hash_block) as block:
+                self.assertEqual(
+                    xcomp.tree_hash(f.name, block_size=8,
+                                    checkpoints=checkpoints),
+                    xcomp.tree_hash(f.name, block_size=8)
+                )
+                self.assertEqual(block.call_count, 4 + 8)
+
+            f.seek(32)
+            f.write(b"X")
+            f.flush()
+            with patch('xcomp.hash_block', wraps=xcomp.hash_block) as block:
+                self.assertEqual(
+                    xcomp.tree_hash(f.name, block_size=8,
+                                    checkpoints=checkpoints),
+                    xcomp.tree_hash(f.name, block_size=8)
+                )
+                self.assertEqual(block.call_count, 1 + 8 + 8)
+
+    def test_changed_tree_cache_entries_are_rehashed(self):
+        file1 = path.abspath('fixtures/directory1/file1')
+        args = Arguments('fixtures/directory1', 'fixtures/directory2',
+                         tree_hash=True, block_size=8, verbose=True)
+        with tempfile.NamedTemporaryFile("wt", suffix=".txt") as cache:
+            cache.write(f"xxh64-tree-8:0123456789abcdef '{file1}' size=20 "
+                        "mtime_ns=0 blocks=0000000000000001\n")
+            cache.flush()
+            args.cache_file = [cache.name]
+            with patch('sys.stdout', new=StringIO()) as xcomp_out:
+                xcomp.main(args)
+                self.assertNotIn("0123456789abcdef", xcomp_out.getvalue())
+
+    def test_cache_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_db = path.join(directory, "cache.db")
+            args = Arguments('fixtures/directory1', 'fixtures/directory2',
+                             recursive=True, verbose=True, cache_db=cache_db)
+            with patch('sys.stdout', new=StringIO()) as first_out:
+                xcomp.main(args)
+
+            connection = xcomp.open_cache_database(cache_db)
+            with connection:
+                connection.execute(
+                    "UPDATE hashes SET mtime_ns = 0 WHERE path = ?",
+                    (path.abspath('fixtures/directory1/file1'),))
+            connection.close()
+
+            with patch('sys.stdout', new=StringIO()) as second_out, \
+                    patch('xcomp.xxh3', wraps=xcomp.xxh3) as xxh3:
+                xcomp.main(args)
+                self.assertEqual(
+                    [call.args[0] for call in xxh3.call_args_list],
+                    [path.abspath('fixtures/directory1/file1')]
+                )
+            self.assertEqual(first_out.getvalue().count(" cached\n"), 0)
+            self.assertEqual(second_out.getvalue().count(" cached\n"), 15)
+
+    def test_current_database_row_beats_stale_text_entry(self):
+        file1 = path.abspath('fixtures/directory1/file1')
+        with tempfile.TemporaryDirectory() as directory:
+            cache_db = path.join(directory, "cache.db")
+            args = Arguments('fixtures/directory1', 'fixtures/directory2',
+                             recursive=True, verbose=True, cache_db=cache_db)
+            with patch('sys.stdout', new=StringIO()):
+                xcomp.main(args)
+
+            cache_file = path.join(directory, "cache.txt")
+            with open(cache_file, "wt") as cache:
+                cache.write(f"0123456789abcdef '{file1}' size=20 mtime_ns=0\n")
+            args.cache_file = [cache_file]
+            with patch('sys.stdout', new=StringIO()) as xcomp_out, \
+                    patch('xcomp.xxh3', wraps=xcomp.xxh3) as xxh3:
+                xcomp.main(args)
+                xxh3.assert_not_called()
+            self.assertIn("xcomp: cache: 16 hit(s), 0 miss(es), 0 stale",
+                          xcomp_out.getvalue())
+
+    def test_stale_cache_entries_are_rehashed(self):
+        file1 = path.abspath('fixtures/directory1/file1')
+        args = Arguments('fixtures/directory1', 'fixtures/directory2',
+                         recursive=True, verbose=True)
+        with patch('sys.stdout', new=StringIO()) as first_out:
+            xcomp.main(args)
+        lines = [line for line in first_out.getvalue().splitlines()
+                 if " size=" in line]
+        self.assertEqual(len(lines), 16)
+
+        with tempfile.NamedTemporaryFile("wt", suffix=".txt") as cache:
+            for line in lines:
+                if f"'{file1}'" in line:
+                    line = line.split(" size=")[0] + " size=20 mtime_ns=0"
+                elif "file2" in line:
+                    line = line.split(" size=")[0]
+                cache.write(line + "\n")
+            cache.flush()
+            args.cache_file = [cache.name]
+            with patch('sys.stdout', new=StringIO()) as second_out, \
+                    patch('xcomp.xxh3', wraps=xcomp.xxh3) as xxh3:
+                xcomp.main(args)
+                self.assertEqual(
+                    [call.args[0] for call in xxh3.call_args_list],
+                    [file1]
+                )
+            self.assertIn("xcomp: cache: 15 hit(s), 0 miss(es), 1 stale",
+                          second_out.getvalue())
+
+    def test_update_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            update_cache = path.join(directory, "cache.txt")
+            args = Arguments('fixtures/directory1', 'fixtures/directory2',
+                             recursive=True, update_cache=update_cache)
+            with patch('sys.stdout', new=StringIO()):
+                xcomp.main(args)
+            with open(update_cache) as cache:
+                first_lines = cache.read().splitlines()
+            self.assertTrue(first_lines)
+            self.assertTrue(all(" size=" in line and " mtime_ns=" in line
+                                for line in first_lines))
+
+            with patch('sys.stdout', new=StringIO()), \
+                    patch('xcomp.xxh3', wraps=xcomp.xxh3) as xxh3:
+                xcomp.main(args)
+                xxh3.assert_not_called()
+            with open(update_cache) as cache:
+                self.assertEqual(cache.read().splitlines(), first_lines)
+
+    def test_update_cache_ignores_a_partial_last_line(self):
+        file1 = path.abspath('fixtures/directory1/file1')
+        with tempfile.TemporaryDirectory() as directory:
+            update_cache = path.join(directory, "cache.txt")
+            with open(update_cache, "wt") as cache:
+                cache.write(f"0123456789abcdef '{file1[:-2]}")
+            args = Arguments('fixtures/directory1', 'fixtures/directory2',
+                             update_cache=update_cache)
+            self.assertEqual(xcomp.load_hash_cache(args), {})
+
+            xcomp.append_hash_cache(update_cache,
+                                    [f"0123456789abcdef '{file1}'"])
+            self.assertEqual(xcomp.load_hash_cache(args),
+                             {file1: xcomp.CacheEntry("0123456789abcdef")})
+
+    def test_update_cache_drops_a_long_partial_last_line(self):
+        with tempfile.TemporaryDirectory() as directory:
+            update_cache = path.join(directory, "cache.txt")
+            blocks = ",".join(["0123456789abcdef"] * 6000)
+            with open(update_cache, "wt") as cache:
+                cache.write("0123456789abcdef '/data/big1' size=1\n"
+                            f"0123456789abcdee '/data/big2' blocks={blocks}")
+            with patch('xcomp.READ_BUFFER_SIZE', 65536):
+                xcomp.append_hash_cache(
+                    update_cache, ["0123456789abcdef '/data/big2' size=2"])
+            with open(update_cache) as cache:
+                self.assertEqual(cache.read().splitlines(), [
+                    "0123456789abcdef '/data/big1' size=1",
+                    "0123456789abcdef '/data/big2' size=2"])
+
+            with open(update_cache, "wt") as cache:
+                cache.write(f"0123456789abcdee '/data/big2' blocks={blocks}")
+            with patch('xcomp.READ_BUFFER_SIZE', 65536):
+                xcomp.append_hash_cache(
+                    update_cache, ["0123456789abcdef '/data/big2' size=2"])
+            with open(update_cache) as cache:
+                self.assertEqual(cache.read().splitlines(),
+                                 ["0123456789abcdef '/data/big2' size=2"])
+
+    def test_cache_entries_outside_roots_are_skipped(self):
+        file1 = path.abspath('fixtures/directory1/file1')
+        file2 = path.abspath('fixtures/directory2/file1')
+        with tempfile.NamedTemporaryFile("wt", suffix=".txt") as cache:
+            cache.write(f"0123456789abcdef '{file1}' size=20 mtime_ns=1\n"
+                        f"<0123456789abcdef\t'{file2}'\n"
+                        "0123456789abcdef 'fixtures/directory1/./file2'\n"
+                        "0123456789abcdef '/elsewhere/file1'\n")
+            cache.flush()
+            args = Arguments('.', '.', cache_file=[cache.name])
+            self.assertEqual(
+                xcomp.load_hash_cache(args, ['fixtures/directory1',
+                                             'fixtures/directory2']),
+                {file1: xcomp.CacheEntry("0123456789abcdef", (), 20, 1),
+                 file2: xcomp.CacheEntry("0123456789abcdef"),
+                 path.abspath('fixtures/directory1/file2'):
+                     xcomp.CacheEntry("0123456789abcdef")}
+            )
+
+    def test_root_skip_requires_a_digest(self):
+        file1 = path.abspath('fixtures/directory1/file1')
+        roots = ['fixtures/directory1']
+        with tempfile.NamedTemporaryFile("wt", suffix=".txt") as cache:
+            cache.write(f"0123456789abcdef '{file1}'\nnote '")
+            cache.flush()
+            args = Arguments('.', '.', cache_file=[cache.name])
+            self.assertEqual(xcomp.load_hash_cache(args, roots),
+                             {file1: xcomp.CacheEntry("0123456789abcdef")})
+
+        with tempfile.NamedTemporaryFile("wt", suffix=".txt") as cache:
+            cache.write("note 'elsewhere'\nnote '")
+            cache.flush()
+            args = Arguments('.', '.', cache_file=[cache.name])
+            with self.assertRaises(SystemExit):
+                xcomp.load_hash_cache(args, roots)
+
+    def test_file_table(self):
+        file1 = path.abspath('fixtures/directory1/file1')
+        file_table = xcomp.scan_directory(
+            'fixtures/directory1', Arguments('.', '.'))
+        file_stat = xcomp.stat(file1)
+        self.assertIn(file1, file_table)
+        self.assertEqual(file_table[file1], xcomp.FileStat(
+            file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+            file_stat.st_mtime_ns, file_stat.st_nlink))
+        self.assertEqual(dict(file_table.entries()), dict(file_table))
+
+    def test_hash_index(self):
+        label = "sha256:" + "ab" * 32
+        hash_index = xcomp.HashIndex()
+        hash_index.add("0123456789abcdef", "/a/file1")
+        hash_index.add("size:42", "/a/b/file2")
+        hash_index.add(label, "/a/file3")
+        hash_index.add("0123456789abcdef", "/a/b/file4")
+        hash_index.add(label, "/file5")
+        hash_index.add("partial:0000000000000001", "/a/file6")
+        hash_index.add("0000000000000002", "/file7")
+        hash_index.freeze()
+
+        self.assertEqual(list(hash_index.items()), [
+            ("0123456789abcdef", ["/a/file1", "/a/b/file4"]),
+            ("size:42", ["/a/b/file2"]),
+            (label, ["/a/file3", "/file5"]),
+            ("partial:0000000000000001", ["/a/file6"]),
+            ("0000000000000002", ["/file7"]),
+        ])
+        self.assertEqual(hash_index["size:42"], ["/a/b/file2"])
+        self.assertNotIn("0123456789abcdee", hash_index)
+        self.assertNotIn("size:43", hash_index)
+        self.assertNotIn("xxh3_64:0123456789abcdef", hash_index)
+        self.assertEqual(hash_index.directories, ["/a", "/a/b", "/"])
+
+    def test_cache_root(self):
+        with tempfile.TemporaryDirectory() as directory:
+            update_cache = path.join(directory, "cache.txt")
+            args = Arguments('fixtures/directory1', 'fixtures/directory2',
+                             recursive=True, update_cache=update_cache,
+                             cache_root='fixtures')
+            with patch('sys.stdout', new=StringIO()):
+                xcomp.main(args)
+            with open(update_cache) as cache:
+                lines = cache.read().splitlines()
+            self.assertIn("'directory1/file1' ", "\n".join(lines))
+            self.assertNotIn(path.abspath('fixtures'), "\n".join(lines))
+
+            mount_point = path.join(directory, "mount")
+            makedirs(mount_point)
+            for tree in ('directory1', 'directory2'):
+                symlink(path.abspath(path.join('fixtures', tree)),
+                        path.join(mount_point, tree))
+            args = Arguments(path.join(mount_point, 'directory1/'),
+                             path.join(mount_point, 'directory2/'),
+                             recursive=True, cache_file=[update_cache],
+                             cache_root=mount_point, verbose=True)
+            with patch('sys.stdout', new=StringIO()) as xcomp_out, \
+                    patch('xcomp.xxh3', wraps=xcomp.xxh3) as xxh3:
+                xcomp.main(args)
+                xxh3.assert_not_called()
+            self.assertIn(f"xcomp: cache: {len(lines)} hit(s), 0 miss(es)",
+                          xcomp_out.getvalue())
+
+    def test_sharded_cache(self):
+        self.assertEqual(xcomp.get_shard_prefix("a/b/c/file", 2), "a/b/")
+        self.assertEqual(xcomp.get_shard_prefix("/a/b/file", 1), "/a/")
+        self.assertEqual(xcomp.get_shard_prefix("file", 1), "")
+
+        with tempfile.TemporaryDirectory() as directory:
+            update_cache = path.join(directory, "cache.txt")
+            args = Arguments('fixtures/directory1', 'fixtures/directory2',
+                             recursive=True, verbose=True,
+                             update_cache=update_cache, cache_root='fixtures')
+            with patch('sys.stdout', new=StringIO()):
+                xcomp.main(args)
+
+            shards = path.join(directory, "shards")
+            self.assertEqual(
+                xcomp.shard_hash_cache([update_cache], shards, 1), 2)
+            args = Arguments('.', '.', cache_file=[shards],
+                             cache_root='fixtures')
+            self.assertEqual(
+                xcomp.select_cache_shards(
+                    shards, path.abspath('fixtures'),
+                    (path.abspath('fixtures/directory2/subdir1') + '/',)),
+                [path.join(shards, "00001.txt")]
+            )
+            hash_cache = xcomp.load_hash_cache(
+                args, ['fixtures/directory2/subdir1'])
+            self.assertEqual(
+                sorted(hash_cache),
+                [path.abspath('fixtures/directory2/subdir1/w'),
+                 path.abspath('fixtures/directory2/subdir1/y')]
+            )
+
+    def test_sharding_keeps_few_files_open(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_file = path.join(directory, "cache.txt")
+            with open(cache_file, "wt") as cache:
+                for index in range(300):
+                    cache.write(f"0123456789abcdef 'd{index}/file'\n")
+            shards = path.join(directory, "shards")
+            limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (64, limits[1]))
+            try:
+                with patch('xcomp.SHARD_BUFFER_LINES', 100):
+                    self.assertEqual(
+                        xcomp.shard_hash_cache([cache_file], shards, 1), 300)
+            finally:
+                resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+            self.assertEqual(len(listdir(shards)), 301)
+            with open(path.join(shards, "00299.txt")) as shard:
+                self.assertEqual(shard.read(),
+                                 "0123456789abcdef 'd299/file'\n")
+
+    def test_packed_cache(self):
+        file1 = path.abspath('fixtures/directory1/file1')
+        with tempfile.TemporaryDirectory() as directory:
+            cache_file = path.join(directory, "cache.txt")
+            with open(cache_file, "wt") as cache:
+                cache.write("0123456789abcdef 'directory1/file1'\n"
+                            f"0123456789abcdee '{file1}' size=20 "
+                            "mtime_ns=1\n"
+                            "xxh3_64:0123456789abcdef 'directory1/file2'\n"
+                            "xxh64-tree-8:0123456789abcdef 'directory1/file3' "
+                            "blocks=0000000000000001,0000000000000002\n"
+                            "0123456789abcdef 'directory1/file4'\n")
+            packed_file = path.join(directory, "cache.pack")
+            self.assertEqual(
+                xcomp.pack_hash_cache([cache_file], packed_file, "xxh64"), 3)
+
+            args = Arguments('.', '.', cache_file=[packed_file],
+                             cache_root='fixtures')
+            hash_cache = xcomp.load_hash_cache(args)
+            self.assertEqual(
+                hash_cache[path.abspath('fixtures/directory1/file4')],
+                xcomp.CacheEntry("0123456789abcdef"))
+            self.assertEqual(hash_cache[file1],
+                             xcomp.CacheEntry("0123456789abcdee", (), 20, 1))
+            self.assertEqual(hash_cache.get(file1.replace("1", "2")), None)
+            self.assertNotIn(path.abspath('fixtures/directory1/file5'),
+                             hash_cache)
+
+            unpacked_file = path.join(directory, "unpacked.txt")
+            self.assertEqual(
+                xcomp.unpack_hash_cache(packed_file, unpacked_file), 3)
+            with open(unpacked_file) as unpacked:
+                self.assertEqual(sorted(unpacked.read().splitlines()), [
+                    f"0123456789abcdee '{file1}' size=20 mtime_ns=1",
+                    "0123456789abcdef 'directory1/file1'",
+                    "0123456789abcdef 'directory1/file4'",
+                ])
+
+            tree_file = path.join(directory, "tree.pack")
+            xcomp.pack_hash_cache([cache_file], tree_file, "xxh64-tree-8")
+            args = Arguments('.', '.', cache_file=[tree_file],
+                             cache_root='fixtures', tree_hash=True,
+                             block_size=8)
+            self.assertEqual(
+                xcomp.load_hash_cache(args)[
+                    path.abspath('fixtures/directory1/file3')],
+                xcomp.CacheEntry(
+                    "xxh64-tree-8:0123456789abcdef",
+                    ("0000000000000001", "0000000000000002")))
+
 
 if __name__ == '__main__':
     unittest.main()